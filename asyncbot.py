@@ -0,0 +1,338 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import asyncio, time, logging
+from atproto import models
+import atproto_client.exceptions
+import atproto_client, atproto_server
+from bot import BlueSkyBot
+from outbound import PRIORITY_REPLY, PRIORITY_BROADCAST
+from clients import ClientRegistry
+from followstream import FollowStream
+from logpipe import RELAY_LOGGER
+from metrics import GET_LOG_SECONDS, EVENTS_PER_POLL, FANOUT_SECONDS, BROADCAST_RECIPIENTS, RECONNECTS, ERRORS
+
+log = logging.getLogger("echochamber.asyncbot")
+relay_log = logging.getLogger(RELAY_LOGGER)
+
+class AsyncBlueSkyBot(BlueSkyBot):
+    # Runs one chamber as a coroutine on a shared event loop.
+    #
+    # Command handling, follower bookkeeping and message composition are
+    # inherited from BlueSkyBot and stay synchronous. Only the network I/O is
+    # async: followers are refreshed before a log page is processed, and
+    # everything the handlers want to say goes through the outbox, drained by
+    # one delivery task that sends replies ahead of broadcasts.
+
+    def __init__(self, queue, handle, username, password, hostname, fanout_concurrency=None):
+        self.init_state(queue, handle, username, password, hostname, fanout_concurrency)
+        self.outbox_ready = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.task = None
+
+    @staticmethod
+    async def create(queue, handle, username, password, hostname, fanout_concurrency=None):
+        bot = AsyncBlueSkyBot(queue, handle, username, password, hostname, fanout_concurrency)
+        await bot.connect()
+        log.info(f"AsyncBlueSkyBot connected to {bot.hostname} with handle {bot.handle} did {bot.did}")
+        await bot.inform_about_followers()
+        return bot
+
+    async def connect(self):
+        self.client = ClientRegistry.make_async_client(self.hostname)
+        self.client.on_session_change(self.on_session_change_async)
+        await self.login()
+        self.dm_client = self.client.with_bsky_chat_proxy()
+        self.dm_client.on_session_change(self.on_session_change_async)
+        self.did = await ClientRegistry.handles.resolve_async(self.handle)
+
+    async def reconnect(self, reason):
+        RECONNECTS.inc(reason)
+        await self.connect()
+
+    async def login(self):
+        session_string = self.sessions.load()
+        if session_string:
+            try:
+                self.count_call("com.atproto.server.refreshSession")
+                await self.client.login(session_string=session_string)
+                log.info(f"AsyncBlueSkyBot {self.handle} resumed stored session")
+                return
+            except Exception as e:
+                if not BlueSkyBot.is_session_rejected(e):
+                    raise
+                log.info(f"AsyncBlueSkyBot {self.handle} stored session not usable, {e}")
+                self.sessions.clear()
+        self.count_call("com.atproto.server.createSession")
+        await self.client.login(
+            self.username,
+            self.password
+        )
+        self.sessions.save(self.client.export_session_string())
+
+    async def on_session_change_async(self, event, session):
+        self.on_session_change(event, session)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        self.register()
+        self.warm_task = asyncio.create_task(self.warm_convos())
+
+    def is_running(self):
+        return not self.task.done()
+
+    async def shutdown(self):
+        self.request_stop()
+        await asyncio.gather(self.task, self.warm_task, return_exceptions=True)
+
+    async def pause(self, seconds):
+        # Sleeps, unless the bot is asked to stop
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def restart(self):
+        bot = await AsyncBlueSkyBot.create(self.queue, self.handle, self.username, self.password, self.hostname,
+                                           self.fanout_concurrency)
+        bot.start()
+
+    async def run(self):
+        log.info(f"AsyncBlueSkyBot {self.handle} starting")
+        self.polling = True
+        worker = asyncio.create_task(self.deliver_outbox_async())
+        try:
+            await self.listen_to_users()
+        except Exception as e:
+            log.exception(f"AsyncBlueSkyBot {self.handle} failed", exc_info=e)
+        finally:
+            self.polling = False
+            self.outbox_ready.set()
+            FollowStream.unregister(self)
+            # Let replies like the shutdown confirmation go out before leaving
+            await asyncio.gather(worker, return_exceptions=True)
+            self.outbox.close()
+            self.convo_ids.flush()
+        log.info(f"AsyncBlueSkyBot {self.handle} stopping")
+
+    async def listen_to_users(self):
+        log.info(f"AsyncBlueSkyBot {self.handle} listening...")
+        log_cursor = self.log_state.cursor
+        bsky_retries = 0
+        reconnect_reason = None
+        await self.pause(self.poll_scheduler.initial_delay())
+        while not self.stop and bsky_retries < 10:
+            await self.breaker.wait_async(self.stopping)
+            if self.stop:
+                self.breaker.release()
+                break
+            poll_started = time.monotonic()
+            try:
+                if reconnect_reason:
+                    await self.reconnect(reconnect_reason)
+                    reconnect_reason = None
+                self.count_call("chat.bsky.convo.getLog")
+                with self.timings.phase("get_log"):
+                    dm_logs = await self.dm_client.chat.bsky.convo.get_log({"cursor":log_cursor})
+                self.breaker.success()
+            except atproto_client.exceptions.InvokeTimeoutError as e:
+                ERRORS.inc(type(e).__name__)
+                log.warning(f"Unable to reach BSKY")
+                self.breaker.failure()
+                continue
+            except atproto_server.exceptions.InvalidTokenError as e:
+                ERRORS.inc(type(e).__name__)
+                log_cursor = None # Old cursor not valid with new connection
+                log.info("Invalid token, renewing connection")
+                await asyncio.sleep(2)
+                reconnect_reason = "invalid_token"
+                continue
+            except atproto_client.exceptions.BadRequestError as e:
+                ERRORS.inc(type(e).__name__)
+                if e.response.content.error == "ExpiredToken":
+                    log.info("Expired token, renewing connection")
+                    await asyncio.sleep(2)
+                    reconnect_reason = "expired_token"
+                    continue
+                else:
+                    raise
+            except atproto_client.exceptions.NetworkError as e:
+                ERRORS.inc(type(e).__name__)
+                log.info("Network error, renewing connection")
+                self.breaker.failure()
+                reconnect_reason = "network_error"
+                continue
+            except atproto_client.exceptions.ModelError as e:
+                ERRORS.inc(type(e).__name__)
+                log.exception(f"Pydantic validation exception")
+                continue
+            except Exception as e:
+                ERRORS.inc(type(e).__name__)
+                log.exception(f"Other bsky exception", exc_info=e)
+                if bsky_retries >= 3:
+                    log.error(f"Unable to get message log, {bsky_retries} retries")
+                    raise Exception("BSKY Unable to get message log")
+                bsky_retries += 1
+                log_cursor = None # Max cursor life is about one hour
+                log.info("Renewing cursor")
+                await asyncio.sleep(2)
+                continue
+            finally:
+                self.breaker.release()
+            GET_LOG_SECONDS.observe(self.handle, value=time.monotonic() - poll_started)
+            EVENTS_PER_POLL.observe(self.handle, value=len(dm_logs.logs))
+            bsky_retries = 0
+            self.log_state.advance(dm_logs.cursor)
+            log_cursor = self.log_state.cursor
+            await self.apply_follow_changes_async()
+            activity = sum(1 for event in dm_logs.logs if self.is_activity(event))
+            if activity:
+                force = any(self.is_membership_event(event) for event in dm_logs.logs)
+                await self.refresh_followers(force)
+            with self.timings.phase("process_events"):
+                for event in dm_logs.logs:
+                    self.process_event(event)
+                self.flush_broadcasts()
+            self.log_state.save()
+            # Polling interval
+            await self.pause(self.poll_scheduler.next_interval(activity))
+        log.info(f"AsyncBlueSkyBot {self.handle} Terminating.")
+
+    async def deliver_outbox_async(self):
+        deadline = None
+        while True:
+            delay = self.outbox.next_due()
+            try:
+                await asyncio.wait_for(self.outbox_ready.wait(), timeout=None if delay is None else max(delay, 0.1))
+            except asyncio.TimeoutError:
+                pass
+            self.outbox_ready.clear()
+            await self.deliver_due_async()
+            if not self.polling:
+                deadline = deadline or time.monotonic() + 30
+                if self.outbox.next_due() != 0 or time.monotonic() > deadline:
+                    break
+
+    async def deliver_due_async(self):
+        await self.deliver_batches_async(self.outbox.due(PRIORITY_REPLY))
+        for broadcast in self.outbox.due(PRIORITY_BROADCAST):
+            await self.deliver_batches_async([broadcast])
+            await self.deliver_batches_async(self.outbox.due(PRIORITY_REPLY))
+
+    async def deliver_batches_async(self, batches):
+        for batch, recipients in batches:
+            try:
+                await self.deliver_batch_async(batch, recipients)
+            except Exception as e:
+                log.exception(f"AsyncBlueSkyBot {self.handle} delivery of {batch.key} failed", exc_info=e)
+
+    async def deliver_batch_async(self, batch, recipients):
+        message = models.get_or_create(batch.message, models.ChatBskyConvoDefs.MessageInput)
+        async def tell_member(member_did):
+            try:
+                await self.send_to_user(member_did, message, batch.priority)
+            except Exception as e:
+                self.outbox.failed(batch.key, member_did, BlueSkyBot.is_permanent_failure(e))
+                raise
+            self.outbox.delivered(batch.key, member_did)
+        with self.timings.phase("broadcast" if batch.priority == PRIORITY_BROADCAST else "reply"):
+            report = await self.fanout.send_async(recipients, tell_member)
+        if batch.priority == PRIORITY_BROADCAST:
+            FANOUT_SECONDS.observe(self.handle, value=report.duration)
+            BROADCAST_RECIPIENTS.observe(self.handle, value=len(recipients))
+            relay_log.info("Broadcast %s in %s: %s", batch.key, self.handle, report)
+        return report
+
+    def update_followers(self, force=False):
+        # Followers are refreshed asynchronously before each log page that
+        # needs them, see refresh_followers()
+        pass
+
+    async def apply_follow_changes_async(self):
+        while self.follow_changes:
+            change, did = self.follow_changes.popleft()
+            if change == "follow":
+                if did in self.followers or did in self.muted_users:
+                    continue
+                try:
+                    self.count_call("app.bsky.actor.getProfile")
+                    self.follower_cache.add(await self.client.app.bsky.actor.get_profile({"actor": did}))
+                except Exception as e:
+                    log.warning(f"AsyncBlueSkyBot {self.handle} could not look up new follower {did}, {e}")
+                    self.follower_cache.invalidate()
+            elif change == "unfollow":
+                self.follower_cache.discard(did)
+            else:
+                self.follower_cache.invalidate()
+
+    async def refresh_followers(self, force=False):
+        if force or self.follower_cache.is_stale():
+            with self.timings.phase("update_followers"):
+                self.follower_cache.replace([follower async for follower in self.list_followers()])
+
+    async def inform_about_followers(self):
+        await self.refresh_followers(force=True)
+        self.log_followers()
+
+    async def list_followers(self):
+        cursor = 1
+        while cursor:
+            self.count_call("app.bsky.graph.getFollowers")
+            reply = await self.client.app.bsky.graph.get_followers(params={
+                "actor": self.handle,
+                "cursor": cursor if cursor != 1 else None
+            })
+            for follower in reply.followers:
+                if follower.did not in self.muted_users:
+                    yield follower
+            cursor = reply.cursor
+
+    async def send_to_user(self, user, message, priority=PRIORITY_REPLY):
+        message_input = self.make_message_input(message)
+        relay_log.info("Telling %s %s", user, message_input.text)
+        with self.timings.phase("get_convo"):
+            convo_id = await self.get_user_convo_id(user)
+        try:
+            self.count_call("chat.bsky.convo.sendMessage")
+            with self.timings.phase("send_message"):
+                await self.sender.call_async(
+                    priority,
+                    self.did,
+                    self.dm_client.chat.bsky.convo.send_message,
+                    models.ChatBskyConvoSendMessage.Data(
+                        convo_id=convo_id,
+                        message=message_input,
+                    )
+                )
+        except atproto_client.exceptions.BadRequestError as e:
+            if BlueSkyBot.is_convo_gone(e):
+                # Look the convo up again on the next attempt
+                self.convo_ids.forget(user)
+            raise
+
+    async def get_user_convo_id(self, did):
+        convo_id = self.convo_ids.get(did)
+        if convo_id:
+            return convo_id
+        self.count_call("chat.bsky.convo.getConvoForMembers")
+        convo_id = (await self.dm_client.chat.bsky.convo.get_convo_for_members(
+            models.ChatBskyConvoGetConvoForMembers.Params(members=[self.did, did]),
+        )).convo.id
+        self.convo_ids.put(did, convo_id)
+        return convo_id
+
+    async def warm_convos(self):
+        dids = self.get_unknown_convo_members()
+        for did in dids:
+            if self.stop:
+                break
+            try:
+                await self.get_user_convo_id(did)
+            except Exception as e:
+                log.warning(f"Could not look up convo with {did}, {e}")
+        self.convo_ids.flush()
+        if dids:
+            log.info(f"AsyncBlueSkyBot {self.handle} looked up {len(dids)} convos")
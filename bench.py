@@ -0,0 +1,239 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+# Benchmark Echochamber against the local stand-in in fakebsky.py.
+#
+#   python bench.py --chambers 10 --members 50 --rate 2 --duration 60
+#
+# Starts N chambers with M members each, has random members post at the
+# given total rate, and reports relay latency percentiles (post to delivery
+# per recipient), API calls per message and process memory over time. Exits
+# non-zero when a bot died or nothing was delivered, so a broken run does not
+# pass for a slow one.
+#
+# The bots handle chat.bsky.convo.defs.LogAcceptConvo, which the pinned
+# atproto==0.0.58 does not define, so every bot dies on its first log page.
+# Run the bench with an atproto that has it: a newer release, or 0.0.58 with
+# the logAcceptConvo model added to atproto_client/models/chat/bsky/convo/defs.py
+# (class LogAcceptConvo with convo_id, rev and py_type
+# 'chat.bsky.convo.defs#logAcceptConvo', listed in the getLog output union).
+
+import os, sys, time, random, logging, argparse, tempfile, threading, resource
+from queue import Queue
+from collections import Counter
+
+log = logging.getLogger("echochamber.bench")
+
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MemorySampler:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self.stop = False
+        self.started = time.monotonic()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="memory").start()
+
+    def run(self):
+        while not self.stop:
+            self.samples.append((time.monotonic() - self.started, get_rss(), threading.active_count()))
+            time.sleep(self.interval)
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def build_world(args):
+    from fakebsky import FakeWorld
+    world = FakeWorld(latency=args.latency, jitter=args.jitter, send_rate=args.send_rate)
+    chambers = []
+    members = {}
+    for c in range(args.chambers):
+        chamber = world.add_account(f"chamber{c}.bench.local", password=f"pw{c}")
+        chambers.append(chamber)
+        members[chamber.handle] = []
+        for m in range(args.members):
+            member = world.add_account(f"member{c}-{m}.bench.local", display_name=f"Member {c}-{m}")
+            world.follow(member, chamber)
+            members[chamber.handle].append(member)
+        world.open_convos(chamber)
+    return world, chambers, members
+
+def prepare_environment(args):
+    workdir = tempfile.mkdtemp(prefix="echochamber-bench-")
+    # Never the operator's own, --serve registers the bench chambers there
+    os.environ["ECHOCHAMBER_DATADIR"] = workdir
+    os.environ["ECHOCHAMBER_LOGDIR"] = workdir
+    os.environ.setdefault("ECHOCHAMBER_POLL_MIN", str(args.poll_min))
+    os.environ["ECHOCHAMBER_RUNTIME"] = args.runtime
+    if args.coalesce:
+        os.environ["ECHOCHAMBER_COALESCE"] = "1"
+    open(f"{workdir}/muted_users.txt", "a").close()
+    return workdir
+
+def start_echochamber(args, url, chambers):
+    from clients import ClientRegistry
+    for chamber in chambers:
+        ClientRegistry.handles.remember(chamber.handle, chamber.did)
+    definitions = {chamber.handle: {"username": chamber.handle, "app_password": chamber.password,
+                                    "hostname": url} for chamber in chambers}
+    if args.serve:
+        import serve
+        from chambers import Chambers
+        for handle, definition in definitions.items():
+            Chambers.create(handle, definition["username"], definition["app_password"], definition["hostname"])
+        threading.Thread(target=serve.main, daemon=True, name="serve").start()
+    else:
+        import serve
+        from followstream import FollowStream
+        FollowStream.start()
+        serve.start_chambers(Queue(), definitions)
+
+def check_atproto():
+    from atproto_client import models
+    return hasattr(models.chat.bsky.convo.defs, "LogAcceptConvo")
+
+def get_dead_bots():
+    from bot import BlueSkyBot
+    return [bot.handle for bot in BlueSkyBot.get_dead_bots()]
+
+def wait_for_bots(count, timeout):
+    from bot import BlueSkyBot
+    deadline = time.monotonic() + timeout
+    while BlueSkyBot.get_bot_count() < count and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return BlueSkyBot.get_bot_count()
+
+def churn(world, chambers, members, rate, duration):
+    # Members leave and rejoin, exercises follower tracking while posting
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        chamber = random.choice(chambers)
+        member = random.choice(members[chamber.handle])
+        world.unfollow(member, chamber)
+        time.sleep(0.5 / rate)
+        world.follow(member, chamber)
+        time.sleep(0.5 / rate)
+
+def drive(world, chambers, members, rate, duration):
+    posted = 0
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        chamber = random.choice(chambers)
+        member = random.choice(members[chamber.handle])
+        world.post(member, chamber, f"hello from the bench [bench:{posted}]")
+        posted += 1
+        next_post = started + posted / rate
+        time.sleep(max(0.0, next_post - time.monotonic()))
+    return posted
+
+def drain(world, expected, timeout):
+    deadline = time.monotonic() + timeout
+    while sum(world.deliveries.values()) < expected and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+def report(args, world, posted, expected, calls, startup_time, bots, dead, sampler, out):
+    delivered = sum(world.deliveries.values())
+    latencies = world.latencies
+    print(f"Echochamber bench: {args.chambers} chambers x {args.members} members, "
+          f"{args.rate} msg/s for {args.duration}s, runtime {args.runtime}"
+          f"{' via serve.main' if args.serve else ''}", file=out)
+    print(f"Fake host: latency {args.latency}s +/- {args.jitter}s, "
+          f"send rate limit {args.send_rate or 'none'}/s per account", file=out)
+    print(f"Startup: {bots}/{args.chambers} chambers in {startup_time:.1f}s", file=out)
+    if dead:
+        print(f"Dead bots: {len(dead)}, {', '.join(sorted(dead))}", file=out)
+    print(f"Messages: {posted} posted, {delivered}/{expected} deliveries", file=out)
+    print(f"Relay latency: p50 {percentile(latencies, 50):.3f}s  p90 {percentile(latencies, 90):.3f}s  "
+          f"p99 {percentile(latencies, 99):.3f}s  max {max(latencies, default=float('nan')):.3f}s", file=out)
+    total_calls = sum(calls.values())
+    print(f"API calls: {total_calls} total, {total_calls / max(posted, 1):.1f} per message", file=out)
+    for nsid, count in calls.most_common():
+        print(f"  {nsid:40} {count:8}  {count / max(posted, 1):8.1f}/msg", file=out)
+    print("Memory over time:", file=out)
+    step = max(1, len(sampler.samples) // 20)
+    for elapsed, rss, threads in sampler.samples[::step]:
+        print(f"  {elapsed:7.1f}s  {rss / 2**20:8.1f} MiB  {threads:5} threads", file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Echochamber against a local fake BlueSky")
+    parser.add_argument("--chambers", type=int, default=5)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second, all chambers")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of traffic")
+    parser.add_argument("--drain", type=float, default=60.0, help="max seconds to wait for deliveries")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every API call")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--send-rate", type=float, default=None, help="sendMessage calls/s per account")
+    parser.add_argument("--poll-min", type=float, default=1.0)
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--serve", action="store_true", help="run the chambers through serve.main")
+    parser.add_argument("--coalesce", action="store_true", help="one DM per member per poll")
+    parser.add_argument("--follow-stream", action="store_true", help="track followers from a fake Jetstream")
+    parser.add_argument("--churn", type=float, default=0.0, help="unfollow/refollow pairs per second, makes delivery counts approximate")
+    parser.add_argument("--output", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+    if not check_atproto():
+        print("The installed atproto has no LogAcceptConvo model and the bots would die, "
+              "see the top of bench.py", file=sys.stderr)
+        return 2
+
+    workdir = prepare_environment(args)
+    if not args.serve:
+        logging.basicConfig(level=logging.WARNING, filename=f"{workdir}/bench.log")
+    if args.runtime == "asyncio" and not args.serve:
+        parser.error("--runtime asyncio needs --serve")
+
+    from fakebsky import FakeBsky
+    world, chambers, members = build_world(args)
+    url = FakeBsky(world).start()
+    if args.follow_stream:
+        from fakebsky import FakeJetstream
+        os.environ["ECHOCHAMBER_FOLLOW_STREAM"] = FakeJetstream(world).start()
+
+    sampler = MemorySampler()
+    sampler.start()
+    started = time.monotonic()
+    start_echochamber(args, url, chambers)
+    bots = wait_for_bots(args.chambers, timeout=120)
+    startup_time = time.monotonic() - started
+    time.sleep(2 * args.poll_min)
+
+    calls_before = Counter(world.calls)
+    if args.churn:
+        threading.Thread(target=churn, args=(world, chambers, members, args.churn, args.duration),
+                         daemon=True, name="churn").start()
+    posted = drive(world, chambers, members, args.rate, args.duration)
+    expected = posted * (args.members - 1)
+    drain(world, expected, args.drain)
+    calls = Counter(world.calls)
+    calls.subtract(calls_before)
+    sampler.stop = True
+    dead = get_dead_bots()
+
+    report(args, world, posted, expected, +calls, startup_time, bots, dead, sampler, sys.stdout)
+    if args.output:
+        with open(args.output, "w") as out:
+            report(args, world, posted, expected, +calls, startup_time, bots, dead, sampler, out)
+    if bots < args.chambers or dead:
+        print(f"Bench failed: {bots}/{args.chambers} chambers started, {len(dead)} died, see {workdir}", file=sys.stderr)
+        return 1
+    if posted and not sum(world.deliveries.values()):
+        print(f"Bench failed: nothing was delivered, see {workdir}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
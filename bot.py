@@ -4,12 +4,29 @@
 # (C) 2025 All For Eco AB, Jan Lindblad
 # See LICENSE for license conditions
 
-import os, time, logging
-from threading import Thread, get_ident
-from atproto import Client, models, IdResolver, client_utils
+import os, time, zlib, hashlib, logging
+from uuid import uuid4
+from threading import Thread, Event, get_ident
+from collections import deque
+from atproto import models
 import atproto_client.exceptions
 import atproto_client, atproto_server
 from msgs import ShutdownMsg, StartupMsg
+from fanout import FanOut
+from polling import PollScheduler
+from followers import FollowerCache
+from convos import ConvoStore
+from logstate import LogState
+from outbound import SendScheduler, PRIORITY_REPLY, PRIORITY_BROADCAST
+from clients import ClientRegistry
+from sessions import SessionStore
+from mutes import MuteList
+from followstream import FollowStream
+from logpipe import RELAY_LOGGER
+from timing import PhaseTimer, SamplingProfiler
+from breaker import CircuitBreaker
+from outbox import Outbox
+from metrics import GET_LOG_SECONDS, EVENTS_PER_POLL, FANOUT_SECONDS, BROADCAST_RECIPIENTS, API_CALLS, RECONNECTS, ERRORS
 
 # FIXME
 # patched ...python.../site-packages/atproto_client/models/chat/bsky/convo/get_log.py
@@ -22,89 +39,241 @@ from msgs import ShutdownMsg, StartupMsg
 #                 'models.ChatBskyConvoDefs.LogReadMessage', # FIXME JANL
 
 log = logging.getLogger("echochamber.bot")
+relay_log = logging.getLogger(RELAY_LOGGER)
+
+# chat.bsky.convo.defs#messageInput allows 1000 graphemes
+MAX_MESSAGE_LENGTH = 1000
 
 class BlueSkyBot(Thread):
     running_bots = {}
 
+    @staticmethod
+    def get_default_coalesce():
+        # Relay all messages from one getLog page as one DM per member
+        return os.environ.get("ECHOCHAMBER_COALESCE", "0") not in ("0", "false", "no")
+
     @staticmethod
     def get_bot_count():
         return len(BlueSkyBot.running_bots)
 
-    def __init__(self, queue, handle, username, password, hostname):
+    def __init__(self, queue, handle, username, password, hostname, fanout_concurrency=None):
         super().__init__()
+        self.init_state(queue, handle, username, password, hostname, fanout_concurrency)
+        self.connect()
+        log.info(f"BlueSkyBot connected to {self.hostname} with handle {self.handle} did {self.did}")
+        self.inform_about_followers()
+
+    def init_state(self, queue, handle, username, password, hostname, fanout_concurrency=None):
         self.queue = queue
         self.username = username
         self.password = password
         self.hostname = hostname
         self.handle   = handle
         self.stop = False
-        self.convo = {}
-        self.followers = {}
+        self.stopping = Event()
+        self.convo_ids = ConvoStore(handle)
+        self.follower_cache = FollowerCache(handle, FollowStream.get_reconcile_interval() if FollowStream.is_enabled() else None)
+        self.follow_changes = deque()
         self.communicated_followers = {}
-        self.muted_users = self.read_muted_users()
-        self.recently_processed_messages = set() # FIXME occasionally prune this set
-        self.connect()
-        log.info(f"BlueSkyBot connected to {self.hostname} with handle {self.handle} did {self.did}")
-        self.inform_about_followers()
+        self.muted_users = MuteList.shared()
+        self.log_state = LogState(handle)
+        self.sender = SendScheduler.for_host(hostname)
+        self.breaker = CircuitBreaker.for_host(hostname)
+        self.outbox = Outbox(handle)
+        self.outbox_ready = Event()
+        self.polling = False
+        self.fanout_concurrency = fanout_concurrency
+        self.sessions = SessionStore(handle)
+        self.fanout = FanOut(handle, fanout_concurrency)
+        self.poll_scheduler = PollScheduler(handle)
+        self.coalesce = BlueSkyBot.get_default_coalesce()
+        self.timings = PhaseTimer(handle)
+        self.pending_broadcasts = []
 
     def connect(self):
-        self.client = Client(self.hostname)
+        self.client = ClientRegistry.make_client(self.hostname)
+        self.client.on_session_change(self.on_session_change)
+        self.login()
+        self.dm_client = self.client.with_bsky_chat_proxy()
+        self.dm_client.on_session_change(self.on_session_change)
+        self.did = ClientRegistry.handles.resolve(self.handle)
+
+    def reconnect(self, reason):
+        RECONNECTS.inc(reason)
+        self.connect()
+
+    def count_call(self, endpoint):
+        API_CALLS.inc(self.handle, endpoint)
+
+    def login(self):
+        # Resume the stored session if its refresh token still works,
+        # atproto refreshes the access token as needed
+        session_string = self.sessions.load()
+        if session_string:
+            try:
+                self.count_call("com.atproto.server.refreshSession")
+                self.client.login(session_string=session_string)
+                log.info(f"BlueSkyBot {self.handle} resumed stored session")
+                return
+            except Exception as e:
+                if not BlueSkyBot.is_session_rejected(e):
+                    # The host did not answer, the session may still be good
+                    raise
+                log.info(f"BlueSkyBot {self.handle} stored session not usable, {e}")
+                self.sessions.clear()
+        self.count_call("com.atproto.server.createSession")
         self.client.login(
             self.username, 
             self.password
         )
-        self.dm_client = self.client.with_bsky_chat_proxy()
-        self.id_resolver = IdResolver()
-        self.did = self.id_resolver.handle.resolve(self.handle)
+        self.sessions.save(self.client.export_session_string())
+
+    @staticmethod
+    def is_session_rejected(e):
+        # True when the host turned the stored session down, or it could not
+        # be read, as opposed to the host not being reachable
+        if isinstance(e, (atproto_server.exceptions.InvalidTokenError,
+                          atproto_client.exceptions.UnauthorizedError, ValueError)):
+            return True
+        if isinstance(e, atproto_client.exceptions.BadRequestError):
+            return e.response.content.error in ("ExpiredToken", "InvalidToken")
+        return False
+
+    @staticmethod
+    def is_convo_gone(e):
+        content = getattr(e.response, "content", None)
+        return getattr(content, "error", None) == "InvalidConvo" or \
+               "convo not found" in (getattr(content, "message", None) or "").lower()
+
+    @staticmethod
+    def is_permanent_failure(e):
+        # The host turned the send down, and sending it again will not help.
+        # Rate limits, auth failures and a stale convo get retried.
+        if not isinstance(e, atproto_client.exceptions.RequestErrorBase):
+            return False
+        status = SendScheduler.get_status_code(e)
+        if status is None or not 400 <= status < 500 or status in (401, 429):
+            return False
+        return not BlueSkyBot.is_session_rejected(e) and not BlueSkyBot.is_convo_gone(e)
+
+    def on_session_change(self, event, session):
+        self.sessions.save(session.export())
 
     def start(self):
         self.thread = Thread(target=BlueSkyBot.run, args=[self])
         self.thread.daemon = True
         self.thread.start()
+        self.register()
+        self.warm_thread = Thread(target=self.warm_convos, daemon=True)
+        self.warm_thread.start()
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def request_stop(self):
+        # Wakes the poll loop if it is waiting, and lets it end
+        self.stop = True
+        self.stopping.set()
+        if BlueSkyBot.running_bots.get(self.handle) is self:
+            del BlueSkyBot.running_bots[self.handle]
+
+    def shutdown(self):
+        # Stops this bot and waits until it has let go of its outbox, log
+        # state and convo files, so a replacement can take them over
+        self.request_stop()
+        self.thread.join()
+        self.warm_thread.join()
+
+    def restart(self):
+        # A fresh bot for the same chamber, replacing this one
+        BlueSkyBot(self.queue, self.handle, self.username, self.password, self.hostname,
+                   self.fanout_concurrency).start()
+
+    @staticmethod
+    def get_dead_bots():
+        return [bot for bot in list(BlueSkyBot.running_bots.values())
+                if not bot.stop and not bot.is_running()]
+
+    def register(self):
         already_running_bot = BlueSkyBot.running_bots.get(self.handle)
         if already_running_bot:
             already_running_bot.stop = True
+            already_running_bot.stopping.set()
         BlueSkyBot.running_bots[self.handle] = self
+        FollowStream.register(self)
 
     @staticmethod
     def run(self):
         log.info(f"BlueSkyBot {self.handle}:{get_ident()} starting")
-        self.listen_to_users()
+        self.polling = True
+        worker = Thread(target=self.deliver_outbox, daemon=True)
+        worker.start()
+        try:
+            self.listen_to_users()
+        finally:
+            self.polling = False
+            self.outbox_ready.set()
+            FollowStream.unregister(self)
+            # Let replies like the shutdown confirmation go out before leaving
+            worker.join()
+            self.outbox.close()
+            self.convo_ids.flush()
         log.info(f"BlueSkyBot {self.handle}:{get_ident()} stopping")
 
     def listen_to_users(self):
         log.info(f"BlueSkyBot {self.handle}:{get_ident()} listening...")
-        log_cursor = None
+        log_cursor = self.log_state.cursor
         bsky_retries = 0
+        reconnect_reason = None
+        self.stopping.wait(self.poll_scheduler.initial_delay())
         while not self.stop and bsky_retries < 10:
+            self.breaker.wait(self.stopping)
+            if self.stop:
+                self.breaker.release()
+                break
+            poll_started = time.monotonic()
             try:
-                dm_logs = self.dm_client.chat.bsky.convo.get_log({"cursor":log_cursor})
-            except atproto_client.exceptions.InvokeTimeoutError: 
+                if reconnect_reason:
+                    self.reconnect(reconnect_reason)
+                    reconnect_reason = None
+                self.count_call("chat.bsky.convo.getLog")
+                with self.timings.phase("get_log"):
+                    dm_logs = self.dm_client.chat.bsky.convo.get_log({"cursor":log_cursor})
+                self.breaker.success()
+            except atproto_client.exceptions.InvokeTimeoutError as e:
+                ERRORS.inc(type(e).__name__)
                 log.warning(f"Unable to reach BSKY")
-                time.sleep(15)
+                self.breaker.failure()
                 continue
             except atproto_server.exceptions.InvalidTokenError as e:
+                ERRORS.inc(type(e).__name__)
                 log_cursor = None # Old cursor not valid with new connection
                 log.info("Invalid token, renewing connection")
                 time.sleep(2)
-                self.connect()
+                reconnect_reason = "invalid_token"
                 continue
             except atproto_client.exceptions.BadRequestError as e:
+                ERRORS.inc(type(e).__name__)
                 if e.response.content.error == "ExpiredToken":
                     log.info("Expired token, renewing connection")
                     time.sleep(2)
-                    self.connect()
+                    reconnect_reason = "expired_token"
+                    continue
                 else:
                     raise
             except atproto_client.exceptions.NetworkError as e:
+                ERRORS.inc(type(e).__name__)
                 log.info("Network error, renewing connection")
-                time.sleep(60)
-                self.connect()
+                # The breaker spaces out the reconnects of all chambers on the host
+                self.breaker.failure()
+                reconnect_reason = "network_error"
                 continue
             except atproto_client.exceptions.ModelError as e:
+                ERRORS.inc(type(e).__name__)
                 log.exception(f"Pydantic validation exception") #, exc_info=e)
                 continue
             except Exception as e:
+                ERRORS.inc(type(e).__name__)
                 log.exception(f"Other bsky exception", exc_info=e)
                 if bsky_retries >= 3:
                     log.error(f"Unable to get message log, {bsky_retries} retries")
@@ -114,49 +283,79 @@ class BlueSkyBot(Thread):
                 log.info("Renewing cursor")
                 time.sleep(2)
                 continue
+            finally:
+                # A probe that ended in neither success nor failure, like an
+                # auth error, must not hold the other chambers back
+                self.breaker.release()
+            GET_LOG_SECONDS.observe(self.handle, value=time.monotonic() - poll_started)
+            EVENTS_PER_POLL.observe(self.handle, value=len(dm_logs.logs))
             bsky_retries = 0
-            log_cursor = dm_logs.cursor
-            for event in dm_logs.logs:
-                if isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogBeginConvo):
-                    # When someone starts a conversation
-                    log.info(f"Received LogBeginConvo event {event}")
-                    #log.info(f"Event details {event.__dict__}")
-                    self.update_followers()
-                    continue
-                elif isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogLeaveConvo):
-                    # When someone leaves a conversation? Never seen
-                    log.info(f"Received LogLeaveConvo event {event}")
-                    # Event details {'convo_id': '3lirhhlpv5a2h', 'rev': '222222335esrd', 'py_type': 'chat.bsky.convo.defs#logLeaveConvo'}
-                    #log.info(f"Event details {event.__dict__}")
-                    self.update_followers()
-                    continue
-                elif isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogAcceptConvo):
-                    # When someone follows?
-                    continue
-                elif not hasattr(event, "message"):
-                    log.debug(f"Received and ignored event: {event} {type(event)}")
-                    continue
-                if event.message.sender.did == self.did:
-                    log.debug(f"Echo of own message {event.message.sender.did}: {event.message.text}")
-                    continue
-                if event.message.text.strip().startswith("/"):
-                    log.info(f"Admin command from {event.message.sender.did}")
-                else:
-                    log.info(f"Message from {event.message.sender.did}: {event.message.text}")
-                # atproto_client.models.chat.bsky.convo.defs.MessageView
-                if event.message.id in self.recently_processed_messages:
-                    log.info(f"Duplicate message {event.message.id}, ignoring")
-                    continue
-                self.recently_processed_messages.add(event.message.id)
-                if not self.handle_command(event.message.sender.did, event.message.text):
-                    log.info(f"Facet details {event.message.facets}")
-                    self.update_followers()
-                    self.tell_room_about_follower_changes()
-                    self.tell_room_users(event.message.sender.did, event.message)
+            self.log_state.advance(dm_logs.cursor)
+            log_cursor = self.log_state.cursor
+            self.apply_follow_changes()
+            if any(self.is_membership_event(event) for event in dm_logs.logs):
+                # One refetch for the page, however many joins and leaves
+                self.update_followers(force=True)
+            with self.timings.phase("process_events"):
+                for event in dm_logs.logs:
+                    self.process_event(event)
+                self.flush_broadcasts()
+            self.log_state.save()
             # Polling interval
-            time.sleep(15)
+            activity = sum(1 for event in dm_logs.logs if self.is_activity(event))
+            self.stopping.wait(self.poll_scheduler.next_interval(activity))
         log.info(f"BlueSkyBot {self.handle} Terminating.")
 
+    def is_membership_event(self, event):
+        return isinstance(event, (atproto_client.models.chat.bsky.convo.defs.LogBeginConvo,
+                                  atproto_client.models.chat.bsky.convo.defs.LogLeaveConvo))
+
+    def is_activity(self, event):
+        # Events that someone in the room caused, as opposed to echoes of
+        # our own messages and read receipts
+        if self.is_membership_event(event):
+            return True
+        return hasattr(event, "message") and event.message.sender.did != self.did
+
+    def process_event(self, event):
+        if isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogBeginConvo):
+            # When someone starts a conversation
+            log.info(f"Received LogBeginConvo event {event}")
+            #log.info(f"Event details {event.__dict__}")
+            # Followers were refreshed once for the whole page
+            return
+        elif isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogLeaveConvo):
+            # When someone leaves a conversation? Never seen
+            log.info(f"Received LogLeaveConvo event {event}")
+            # Event details {'convo_id': '3lirhhlpv5a2h', 'rev': '222222335esrd', 'py_type': 'chat.bsky.convo.defs#logLeaveConvo'}
+            #log.info(f"Event details {event.__dict__}")
+            return
+        elif isinstance(event, atproto_client.models.chat.bsky.convo.defs.LogAcceptConvo):
+            # When someone follows?
+            return
+        elif not hasattr(event, "message"):
+            log.debug("Received and ignored event: %s %s", event, type(event))
+            return
+        if event.message.sender.did == self.did:
+            relay_log.debug("Echo of own message %s: %s", event.message.sender.did, event.message.text)
+            return
+        if event.message.text.strip().startswith("/"):
+            log.info(f"Admin command from {event.message.sender.did}")
+        else:
+            relay_log.info("Message from %s: %s", event.message.sender.did, event.message.text)
+        # atproto_client.models.chat.bsky.convo.defs.MessageView
+        if not self.log_state.is_new_message(event.message):
+            relay_log.info("Duplicate message %s, ignoring", event.message.id)
+            return
+        if not self.handle_command(event.message.sender.did, event.message.text):
+            relay_log.debug("Facet details %s", event.message.facets)
+            self.update_followers()
+            self.tell_room_about_follower_changes()
+            if self.coalesce:
+                self.pending_broadcasts.append((event.message.sender.did, event.message))
+            else:
+                self.tell_room_users(event.message.sender.did, event.message)
+
     def handle_command(self, sender_did, text):
         try:
             if not text.strip().startswith("/"):
@@ -169,6 +368,7 @@ class BlueSkyBot(Thread):
             elif words[0] == "/who-is":   self.handle_whois_command(sender_did, words[1:])
             elif words[0] == "/mute":     self.handle_mute_command(sender_did, words[1:])
             elif words[0] == "/muted":    self.handle_muted_command(sender_did)
+            elif words[0] == "/stats":    self.handle_stats_command(sender_did, words[1:])
             else:
                 self.tell_one_user(sender_did, "Admin command not understood.")
             return True
@@ -193,6 +393,8 @@ class BlueSkyBot(Thread):
         Mute user with id <did>
 /muted
         List muted users
+/stats <app_password> [reset | profile [<seconds>]]
+        Show where this Echochamber spends its time
 /shutdown <app_password>
         Shut down this Echochamber
 /startup <handle> <username> <app_password> [<hostname>]
@@ -211,6 +413,8 @@ class BlueSkyBot(Thread):
             resp = """/mute <app_password> <did>   Permanently expel the user with the given id from this and all other Echocambers hosted by this server. To do this, the app_password for thie Echochamber needs to be provided."""
         elif cmd == "muted":
             resp = """/muted   List muted users. Muted users are expelled and not able to communicate with the Echochamber."""
+        elif cmd == "stats":
+            resp = """/stats <app_password> [reset | profile [<seconds>]]   Show the time spent per phase of polling and relaying in this Echochamber since it started or since the last reset. With profile, and if the server allows it, sample the whole server for the given number of seconds (default 30) and write a profile to the server log directory. To do this, the app_password for this Echochamber needs to be provided."""
         elif cmd == "shutdown":
             resp = """/shutdown <app_password>   Shutdown this Echochamber. The BlueSky account will remain, but no echoing will happen. To do this, the app_password for thie Echochamber needs to be provided."""
         elif cmd == "startup":
@@ -226,7 +430,7 @@ class BlueSkyBot(Thread):
                 f"Echochamber: Shutdown accepted"
             )
             del BlueSkyBot.running_bots[self.handle]
-            self.queue.put(ShutdownMsg(self.handle))
+            self.queue.put_nowait(ShutdownMsg(self.handle))
             self.stop = True
         else:
             self.tell_one_user(
@@ -248,7 +452,7 @@ class BlueSkyBot(Thread):
             hostname = words.pop(0)
         else:
             hostname = self.hostname
-        self.queue.put(StartupMsg(handle, username, app_password, hostname))
+        self.queue.put_nowait(StartupMsg(handle, username, app_password, hostname))
         self.tell_one_user(
             sender_did, 
             f"Echochamber: Startup of Echochamber {handle} requested"
@@ -278,15 +482,10 @@ class BlueSkyBot(Thread):
             )
 
     def handle_whois_command(self, sender_did, words):
-        count_matching_users = 0
-        for follower in self.followers.values():
-            for word in words:
-                if  word in follower.did or \
-                    word in follower.handle or \
-                    word in follower.display_name:
-                    count_matching_users += 1
-                    self.show_user_details(follower, sender_did)
-        if not count_matching_users:
+        matching_users = self.follower_cache.search(words)
+        if matching_users:
+            self.show_user_details(sender_did, *matching_users)
+        else:
             self.tell_one_user(sender_did, f"No matching users found.")
 
     def show_user_details(self, sender_did, *followers):
@@ -315,83 +514,297 @@ class BlueSkyBot(Thread):
                 f"Echochamber: Muting not authorized"
             )
 
+    def handle_stats_command(self, sender_did, words):
+        if not words or words[0] != self.password:
+            self.tell_one_user(sender_did, f"Echochamber: Stats not authorized")
+            return
+        if words[1:2] == ["reset"]:
+            self.timings.reset()
+            self.tell_one_user(sender_did, f"Echochamber: Timings reset")
+        elif words[1:2] == ["profile"]:
+            if not SamplingProfiler.is_enabled():
+                self.tell_one_user(sender_did, f"Echochamber: Profiling is not enabled on this server")
+                return
+            duration = float(words[2]) if len(words) > 2 else 30
+            filename = SamplingProfiler.start(self.handle, duration)
+            if filename:
+                self.tell_one_user(sender_did, f"Echochamber: Profiling, writing {os.path.basename(filename)} when done")
+            else:
+                self.tell_one_user(sender_did, f"Echochamber: A profile is already being taken")
+        else:
+            self.tell_one_user(sender_did, self.timings.report())
+
     def tell_room_users(self, sender_did, rich_message):
         if sender_did in self.muted_users:
             log.info(f"Muted user {sender_did} is trying to post. Rejected.")
             return
-        from_name = self.get_follower_name(sender_did)
-        for member_did in self.followers:
-            if member_did == sender_did:
+        with self.timings.phase("compose"):
+            message = self.compose_broadcast(self.get_follower_name(sender_did), rich_message)
+        # Relayed messages keep their key if the log page is read again
+        key = f"msg-{rich_message.id}" if hasattr(rich_message, "id") else f"note-{uuid4().hex}"
+        self.send_broadcast(sender_did, self.get_recipients(sender_did), message, key)
+
+    def flush_broadcasts(self):
+        # Coalesced relay of the messages collected from one poll. Members
+        # who did not post get every message, a member who did gets all but
+        # their own, so there is one composition per distinct sender.
+        messages, self.pending_broadcasts = self.pending_broadcasts, []
+        if not messages:
+            return
+        if len(messages) == 1:
+            self.tell_room_users(*messages[0])
+            return
+        parts = []
+        for sender_did, rich_message in messages:
+            if sender_did in self.muted_users:
+                log.info(f"Muted user {sender_did} is trying to post. Rejected.")
+                continue
+            parts.append((sender_did, self.compose_broadcast(self.get_follower_name(sender_did), rich_message)))
+        senders = {sender_did for sender_did, part in parts}
+        page_key = hashlib.sha1("+".join(getattr(rich_message, "id", "") for _, rich_message in messages).encode()).hexdigest()[:16]
+        groups = {}
+        for member_did in self.get_recipients(None):
+            groups.setdefault(member_did if member_did in senders else None, []).append(member_did)
+        for excluded_did, recipients in groups.items():
+            included = [part for sender_did, part in parts if sender_did != excluded_did]
+            group_key = zlib.crc32((excluded_did or "").encode())
+            for n, message in enumerate(BlueSkyBot.join_broadcasts(included)):
+                self.send_broadcast(f"{len(included)} messages", recipients, message, f"page-{page_key}-{group_key}-{n}")
+
+    @staticmethod
+    def join_broadcasts(parts, limit=MAX_MESSAGE_LENGTH):
+        # One line per composed message, facets moved along with their line.
+        # Splits between lines when the next one would pass the limit, and
+        # a line that is longer than the limit on its own into pieces.
+        messages = []
+        text, facets = "", []
+        for part in parts:
+            for piece in BlueSkyBot.split_message(part, limit):
+                if text and len(text) + 1 + len(piece.text) > limit:
+                    messages.append(models.ChatBskyConvoDefs.MessageInput(text=text, facets=facets or None))
+                    text, facets = "", []
+                if text:
+                    text += "\n"
+                facets += BlueSkyBot.shift_facets(piece.facets, len(text.encode("utf-8")))
+                text += piece.text
+        if text:
+            messages.append(models.ChatBskyConvoDefs.MessageInput(text=text, facets=facets or None))
+        return messages
+
+    @staticmethod
+    def split_message(message, limit=MAX_MESSAGE_LENGTH):
+        # Cuts a message longer than the limit, at a space where there is
+        # one. Facets that would be cut in two are dropped.
+        if len(message.text) <= limit:
+            return [message]
+        pieces = []
+        text = message.text
+        start = 0
+        while start < len(text):
+            end = min(start + limit, len(text))
+            if end < len(text):
+                space = text.rfind(" ", start + 1, end + 1)
+                if space > start:
+                    end = space
+            byte_start = len(text[:start].encode("utf-8"))
+            byte_end = len(text[:end].encode("utf-8"))
+            facets = [fac for fac in message.facets or []
+                      if byte_start <= fac.index.byte_start and fac.index.byte_end <= byte_end]
+            pieces.append(models.ChatBskyConvoDefs.MessageInput(
+                text=text[start:end],
+                facets=BlueSkyBot.shift_facets(facets, -byte_start) or None,
+            ))
+            start = end + 1 if text[end:end + 1] == " " else end
+        return pieces
+
+    def send_broadcast(self, origin, recipients, message, key):
+        # origin says where the broadcast came from in the relay log, the
+        # sender's DID or a description of a coalesced page
+        added = self.enqueue(key, PRIORITY_BROADCAST, message, recipients)
+        relay_log.info("Queued broadcast %s from %s in %s to %d members", key, origin, self.handle, added)
+
+    def enqueue(self, key, priority, message, recipients):
+        # Batch keys must not contain ":", it separates them from the DID
+        message_input = self.make_message_input(message)
+        added = self.outbox.add(key, priority, models.get_model_as_dict(message_input), recipients)
+        self.outbox_ready.set()
+        return added
+
+    def deliver_outbox(self):
+        # Sleeps until something is added to the outbox or the next retry is
+        # due. Runs until polling has stopped and the outbox is drained, or
+        # for at most 30s after that; what is left is sent after a restart.
+        deadline = None
+        while True:
+            delay = self.outbox.next_due()
+            self.outbox_ready.wait(None if delay is None else max(delay, 0.1))
+            self.outbox_ready.clear()
+            self.deliver_due()
+            if not self.polling:
+                deadline = deadline or time.monotonic() + 30
+                # Nothing due now, deliveries backing off wait for a restart
+                if self.outbox.next_due() != 0 or time.monotonic() > deadline:
+                    break
+
+    def deliver_due(self):
+        # Replies go first, and again before each broadcast, so a reply
+        # waits for at most one broadcast to finish
+        self.deliver_batches(self.outbox.due(PRIORITY_REPLY))
+        for broadcast in self.outbox.due(PRIORITY_BROADCAST):
+            self.deliver_batches([broadcast])
+            self.deliver_batches(self.outbox.due(PRIORITY_REPLY))
+
+    def deliver_batches(self, batches):
+        for batch, recipients in batches:
+            try:
+                self.deliver_batch(batch, recipients)
+            except Exception as e:
+                log.exception(f"BlueSkyBot {self.handle} delivery of {batch.key} failed", exc_info=e)
+
+    def deliver_batch(self, batch, recipients):
+        message = models.get_or_create(batch.message, models.ChatBskyConvoDefs.MessageInput)
+        def tell_member(member_did):
+            try:
+                self.send_to_user(member_did, message, batch.priority)
+            except Exception as e:
+                self.outbox.failed(batch.key, member_did, BlueSkyBot.is_permanent_failure(e))
+                raise
+            self.outbox.delivered(batch.key, member_did)
+        if batch.priority == PRIORITY_REPLY:
+            # Replies go out on the delivery worker itself, so they never
+            # wait behind broadcast sends queued in the fan-out pool
+            with self.timings.phase("reply"):
+                return self.fanout.send_inline(recipients, tell_member)
+        with self.timings.phase("broadcast"):
+            report = self.fanout.send(recipients, tell_member)
+        FANOUT_SECONDS.observe(self.handle, value=report.duration)
+        BROADCAST_RECIPIENTS.observe(self.handle, value=len(recipients))
+        relay_log.info("Broadcast %s in %s: %s", batch.key, self.handle, report)
+        return report
+
+    def get_recipients(self, sender_did):
+        # Other chambers may have muted a member since our last refresh
+        return [member_did for member_did in self.followers
+                if member_did != sender_did and member_did not in self.muted_users]
+
+    def compose_broadcast(self, from_name, rich_message):
+        # Rendered once per broadcast and shared by every recipient
+        prefix = f"{from_name}: "
+        if isinstance(rich_message, str):
+            return models.ChatBskyConvoDefs.MessageInput(text=prefix + rich_message)
+        facets = BlueSkyBot.shift_facets(rich_message.facets, len(prefix.encode("utf-8")))
+        relay_log.debug("Composed %r with %d facets", rich_message.text, len(facets))
+        return models.ChatBskyConvoDefs.MessageInput(
+            text=prefix + rich_message.text,
+            facets=facets or None,
+        )
+
+    @staticmethod
+    def shift_facets(facets, byte_offset):
+        # Copy the facets we know how to relay, moved byte_offset bytes right
+        shifted = []
+        for i, fac in enumerate(facets or []):
+            if not isinstance(fac, models.AppBskyRichtextFacet.Main):
+                log.warning(f"Facet type unknown, ignored {i}: {fac}")
+                continue
+            features = []
+            for feat in fac.features:
+                if isinstance(feat, (models.AppBskyRichtextFacet.Link,
+                                     models.AppBskyRichtextFacet.Mention,
+                                     models.AppBskyRichtextFacet.Tag)):
+                    features.append(feat)
+                else:
+                    log.warning(f"Feature type unknown, ignored {i}: {fac} {feat}")
+            if not features:
                 continue
-            message_builder = client_utils.TextBuilder()
-            message_builder.text(f"{from_name}: ")
-            self.recompose(message_builder, rich_message)
-            self.tell_one_user(member_did, message_builder)
+            shifted.append(models.AppBskyRichtextFacet.Main(
+                index=models.AppBskyRichtextFacet.ByteSlice(
+                    byte_start=fac.index.byte_start + byte_offset,
+                    byte_end=fac.index.byte_end + byte_offset,
+                ),
+                features=features,
+            ))
+        return shifted
 
     def get_follower_name(self, did):
         if did == self.did:
             return "Echochamber"
-        return self.get_follower_names().get(did, f"Anonymous {did}")
+        return self.follower_cache.name_of(did, f"Anonymous {did}")
 
     def get_follower_names(self, follower_dict = None):
         if not follower_dict:
-            follower_dict = self.followers
-        return {f.did: f.display_name if f.display_name else f.handle for f in follower_dict.values()}
+            return dict(self.follower_cache.names)
+        return {f.did: FollowerCache.display_name_of(f) for f in follower_dict.values()}
+
+    def queue_follow_change(self, change, did):
+        # Called from the follow stream thread
+        self.follow_changes.append((change, did))
+
+    def apply_follow_changes(self):
+        while self.follow_changes:
+            change, did = self.follow_changes.popleft()
+            if change == "follow":
+                if did in self.followers or did in self.muted_users:
+                    continue
+                try:
+                    self.count_call("app.bsky.actor.getProfile")
+                    self.follower_cache.add(self.client.app.bsky.actor.get_profile({"actor": did}))
+                except Exception as e:
+                    log.warning(f"BlueSkyBot {self.handle} could not look up new follower {did}, {e}")
+                    self.follower_cache.invalidate()
+            elif change == "unfollow":
+                self.follower_cache.discard(did)
+            else:
+                self.follower_cache.invalidate()
 
-    def update_followers(self):
-        self.followers = {follower.did:follower for follower in self.list_followers()}
+    @property
+    def followers(self):
+        return self.follower_cache.members
+
+    def update_followers(self, force=False):
+        if force or self.follower_cache.is_stale():
+            with self.timings.phase("update_followers"):
+                self.follower_cache.replace(self.list_followers())
 
     def tell_room_about_follower_changes(self):        
         announce_text = ""
-        new_follows = set(self.followers) - set(self.communicated_followers)
-        new_unfollows = set(self.communicated_followers) - set(self.followers)
+        # Both are DID -> Member, the key views diff without copying
+        new_follows = self.followers.keys() - self.communicated_followers.keys()
+        new_unfollows = self.communicated_followers.keys() - self.followers.keys()
         if new_follows:
-            announce_text += ", ".join([self.get_follower_name(did) for did in self.followers.keys()]) + " joined the conversation. "
+            announce_text += ", ".join([self.get_follower_name(did) for did in new_follows]) + " joined the conversation. "
         if new_unfollows:
-            announce_text += ", ".join([self.get_follower_name(did) for did in self.followers.keys()]) + " left."
+            departed_names = self.get_follower_names({did: self.communicated_followers[did] for did in new_unfollows})
+            announce_text += ", ".join(departed_names.values()) + " left."
         if self.communicated_followers and (new_follows or new_unfollows):
             # If there are no communicated_followers, the server was likely restarted
             # No need to mention anything
             self.tell_room_users(self.did, announce_text)
         if new_follows or new_unfollows:
-            self.communicated_followers = self.followers.copy()
+            self.communicated_followers = dict(self.followers)
 
     def inform_about_followers(self):
-        self.update_followers()
+        self.update_followers(force=True)
+        self.log_followers()
+
+    def log_followers(self):
         if not self.followers:
             log.info("No followers")
             return
         log.info(f"BlueSkyBot {self.handle} has followers:")
         for n, did in enumerate(self.followers.keys()):
-            log.info(f"Follower #{n}: {did} {self.followers[did].display_name} ({self.followers[did].handle}) {self.followers[did]}")
-
-    def get_muted_users_filename(self):
-        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
-        filename = f"{datadir}/muted_users.txt"
-        return filename
-
-    def read_muted_users(self):
-        muted_users = set()
-        filename = self.get_muted_users_filename()
-        with open(filename, "r") as f:
-            self.muted_users = []
-            for didstr in f.readlines():
-                did = didstr.strip()
-                if did and did[0] != "#":
-                    muted_users.add(did)
-        log.info(f"""Muted users: {", ".join(muted_users)}""")
-        return muted_users
+            follower = self.followers[did]
+            log.info("Follower #%d: %s %s (%s)", n, did, follower.display_name, follower.handle)
+            log.debug("Follower #%d profile %s", n, follower)
 
     def mute_user(self, target_did, issuer_did):
-        filename = self.get_muted_users_filename()
-        self.muted_users.add(target_did)
-        with open(filename, "a") as f:
-            print(f"# User {issuer_did} muted {target_did} on {time.ctime()}\n{target_did}", file=f)
-        log.info(f"{issuer_did} muted user {target_did}")
+        self.muted_users.mute(target_did, issuer_did)
+        self.follower_cache.discard(target_did)
 
     def list_followers(self):
         cursor = 1
         while cursor:
+            self.count_call("app.bsky.graph.getFollowers")
             reply = self.client.app.bsky.graph.get_followers(params={
                 "actor": self.handle,
                 "cursor": cursor if cursor != 1 else None
@@ -403,68 +816,70 @@ class BlueSkyBot(Thread):
                     yield follower
             cursor = reply.cursor
 
-    def tell_one_user(self, user, message):
+    def tell_one_user(self, user, message, priority=PRIORITY_REPLY):
+        self.enqueue(f"reply-{uuid4().hex}", priority, message, [user])
+
+    def send_to_user(self, user, message, priority=PRIORITY_REPLY):
+        message_input = self.make_message_input(message)
+        relay_log.info("Telling %s %s", user, message_input.text)
+        with self.timings.phase("get_convo"):
+            convo_id = self.get_user_convo_id(user)
+        try:
+            self.count_call("chat.bsky.convo.sendMessage")
+            with self.timings.phase("send_message"):
+                self.sender.call(
+                    priority,
+                    self.did,
+                    self.dm_client.chat.bsky.convo.send_message,
+                    models.ChatBskyConvoSendMessage.Data(
+                        convo_id=convo_id,
+                        message=message_input,
+                    )
+                )
+        except atproto_client.exceptions.BadRequestError as e:
+            if BlueSkyBot.is_convo_gone(e):
+                # Look the convo up again on the next attempt
+                self.convo_ids.forget(user)
+            raise
+
+    def make_message_input(self, message):
+        if isinstance(message, models.ChatBskyConvoDefs.MessageInput):
+            return message
         if isinstance(message, str):
             message_text = message
             message_facets = None
         else:
             message_text = message.build_text()
             message_facets = message.build_facets()
-        log.info(f"Telling {user} {message_text}")
-        convo = self.get_user_convo(user)
-        self.dm_client.chat.bsky.convo.send_message(
-            models.ChatBskyConvoSendMessage.Data(
-                convo_id=convo.id,
-                message=models.ChatBskyConvoDefs.MessageInput(
-                    text=message_text,
-                    facets=message_facets,
-                ),
-            )
+        return models.ChatBskyConvoDefs.MessageInput(
+            text=message_text,
+            facets=message_facets,
         )
 
-    def get_user_convo(self, did):
-        if did in self.convo:
-            return self.convo[did]
-        self.convo[did] = self.dm_client.chat.bsky.convo.get_convo_for_members(
+    def get_user_convo_id(self, did):
+        convo_id = self.convo_ids.get(did)
+        if convo_id:
+            return convo_id
+        self.count_call("chat.bsky.convo.getConvoForMembers")
+        convo_id = self.dm_client.chat.bsky.convo.get_convo_for_members(
             models.ChatBskyConvoGetConvoForMembers.Params(members=[self.did, did]),
-        ).convo
-        return self.convo[did]
-
-    def recompose(self, message_builder, rich_message):
-        log.info(f"Recompose {rich_message}")
-        if isinstance(rich_message, str):
-            message_builder.text(rich_message)
-            return
-
-        # facets = [Main(features=[Link(uri='https://8.8.8.8/foo', py_type='app.bsky.richtext.facet#link')])]
-        byte_str  = bytearray(rich_message.text, encoding="utf-8")
-        byte_offs = 0
-        if rich_message.facets:
-            for i, fac in enumerate(rich_message.facets):
-                log.info(f"Facet {i}: {fac}")
-                if isinstance(fac, atproto_client.models.AppBskyRichtextFacet.Main):
-                    if fac.index.byte_start > byte_offs:
-                        text_only_slice = byte_str[byte_offs:fac.index.byte_start].decode("utf-8")
-                        log.info(f"  Text: {text_only_slice}")
-                        message_builder.text(text_only_slice)
-                        byte_offs = fac.index.byte_end
-                    substr = byte_str[fac.index.byte_start:fac.index.byte_end].decode("utf-8")
-                    for i, feat in enumerate(fac.features):
-                        byte_offs = fac.index.byte_end
-                        if isinstance(feat, atproto_client.models.AppBskyRichtextFacet.Link):
-                            log.info(f"  Link: {feat} {feat.uri}")
-                            message_builder.link(substr, feat.uri)
-                        elif isinstance(feat, atproto_client.models.AppBskyRichtextFacet.Mention):
-                            log.info(f"  Mention: {feat} {feat.did}")
-                            message_builder.mention(substr, feat.did)
-                        elif isinstance(feat, atproto_client.models.AppBskyRichtextFacet.Tag):
-                            log.info(f"  Tag: {feat} {feat.tag}")
-                            message_builder.tag(str(substr), feat.tag)
-                        else:
-                            log.warning(f"Feature type unknown, ignored {i}: {fac} {feat}")
-                else:
-                    log.warning(f"Facet type unknown, ignored {i}: {fac}")
-        if len(rich_message.text) > byte_offs:
-            text_only_slice = byte_str[byte_offs:].decode("utf-8")
-            log.info(f"  Final Text: {text_only_slice}")
-            message_builder.text(text_only_slice)
+        ).convo.id
+        self.convo_ids.put(did, convo_id)
+        return convo_id
+
+    def get_unknown_convo_members(self):
+        return [did for did in list(self.followers) if did not in self.convo_ids]
+
+    def warm_convos(self):
+        # Look up the convos of current followers ahead of the first broadcast
+        dids = self.get_unknown_convo_members()
+        for did in dids:
+            if self.stop:
+                break
+            try:
+                self.get_user_convo_id(did)
+            except Exception as e:
+                log.warning(f"Could not look up convo with {did}, {e}")
+        self.convo_ids.flush()
+        if dids:
+            log.info(f"BlueSkyBot {self.handle} looked up {len(dids)} convos")
@@ -0,0 +1,138 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, random, logging, asyncio
+from threading import Lock
+from metrics import Gauge
+
+log = logging.getLogger("echochamber.breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BREAKER_OPEN = Gauge("echochamber_breaker_open",
+    "1 while the circuit breaker for a BlueSky host is open", ["hostname"])
+
+class CircuitBreaker:
+    # Shared by every chamber on one BlueSky host, so an outage is met
+    # with one backoff instead of every chamber retrying on its own.
+    #
+    # A number of host failures in a row opens the breaker for an
+    # exponentially growing, jittered delay. When it has passed, one caller
+    # gets through as the probe while the rest keep waiting. A successful
+    # probe closes the breaker, a failed one opens it again for longer. A
+    # probe that ends in neither, e.g. on an auth error, is released so the
+    # next caller can probe at once instead of after `probe_timeout`.
+
+    breakers = {}
+    breakers_lock = Lock()
+
+    @staticmethod
+    def for_host(hostname):
+        with CircuitBreaker.breakers_lock:
+            breaker = CircuitBreaker.breakers.get(hostname)
+            if not breaker:
+                breaker = CircuitBreaker(hostname)
+                CircuitBreaker.breakers[hostname] = breaker
+            return breaker
+
+    @staticmethod
+    def get_default_threshold():
+        return int(os.environ.get("ECHOCHAMBER_BREAKER_THRESHOLD", "2"))
+
+    @staticmethod
+    def get_default_max_delay():
+        return float(os.environ.get("ECHOCHAMBER_BREAKER_MAX_DELAY", "300"))
+
+    def __init__(self, hostname, threshold=None, base_delay=2.0, max_delay=None, probe_timeout=120):
+        self.hostname = hostname
+        self.threshold = threshold or CircuitBreaker.get_default_threshold()
+        self.base_delay = base_delay
+        self.max_delay = max_delay or CircuitBreaker.get_default_max_delay()
+        self.probe_timeout = probe_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.openings = 0
+        self.reopen_at = 0.0
+        self.probe_started = 0.0
+        self.lock = Lock()
+        BREAKER_OPEN.set(hostname, value=0)
+
+    def try_enter(self):
+        # Returns 0 when the caller may talk to the host, otherwise how
+        # long to wait before asking again
+        with self.lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return 0
+            if self.state == HALF_OPEN:
+                if now - self.probe_started < self.probe_timeout:
+                    return random.uniform(1, 3)
+                # The probe never reported back, let another one through
+            elif now < self.reopen_at:
+                return self.reopen_at - now + random.uniform(0, 1)
+            self.state = HALF_OPEN
+            self.probe_started = now
+            log.info(f"Circuit breaker for {self.hostname} half open, probing")
+            return 0
+
+    def wait(self, stopping=None):
+        # Returns early, without entering, once the `stopping` event is set
+        while not (stopping and stopping.is_set()):
+            delay = self.try_enter()
+            if not delay:
+                return
+            if stopping:
+                stopping.wait(delay)
+            else:
+                time.sleep(delay)
+
+    async def wait_async(self, stopping=None):
+        while not (stopping and stopping.is_set()):
+            delay = self.try_enter()
+            if not delay:
+                return
+            if stopping:
+                try:
+                    await asyncio.wait_for(stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(delay)
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                log.info(f"Circuit breaker for {self.hostname} closed")
+                BREAKER_OPEN.set(self.hostname, value=0)
+            self.state = CLOSED
+            self.failures = 0
+            self.openings = 0
+
+    def release(self):
+        # Called when a call to the host is over. If it was the probe and
+        # neither closed nor opened the breaker, the next caller probes.
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.reopen_at = time.monotonic()
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == OPEN:
+                # Calls that were already under way when it opened
+                return
+            if self.state == CLOSED and self.failures < self.threshold:
+                return
+            delay = min(self.max_delay, self.base_delay * 2 ** self.openings)
+            delay = random.uniform(delay / 2, delay)
+            self.openings += 1
+            self.state = OPEN
+            self.reopen_at = time.monotonic() + delay
+            BREAKER_OPEN.set(self.hostname, value=1)
+            log.warning(f"Circuit breaker for {self.hostname} open for {delay:.1f}s after {self.failures} failures")
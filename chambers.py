@@ -4,50 +4,134 @@
 # (C) 2025 All For Eco AB, Jan Lindblad
 # See LICENSE for license conditions
 
-import os, glob, json, logging
+import os, glob, json, sqlite3, logging
+from threading import Lock
 
 log = logging.getLogger("echochamber.chambers")
 
 class Chambers:
+    # Chamber definitions live in one SQLite database in WAL mode, so a
+    # lookup, create or delete touches one row instead of every chamber.
+    # <handle>.chamber files found in the data directory are imported the
+    # first time the registry is opened, and on every rescan, and renamed to
+    # .chamber.imported.
+    #
+    # To change a chamber, e.g. a new app password or hostname, write its
+    # whole definition to <handle>.chamber in the data directory again. The
+    # import replaces the stored definition, and with reconciling on, the
+    # running bot is restarted with it.
+
+    required_keys = ("username", "app_password", "hostname")
+    imported = False
+    import_lock = Lock()
+
+    @staticmethod
+    def is_valid(definition):
+        return isinstance(definition, dict) and all(key in definition for key in Chambers.required_keys)
+
     @staticmethod
     def make_chamber_file_path(handle):
         datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
         return f"{datadir}/{handle}.chamber"
 
+    @staticmethod
+    def make_registry_path():
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/chambers.db"
+
     @staticmethod
     def get_chamber_files():
         file_pattern = Chambers.make_chamber_file_path("*")
         return glob.glob(file_pattern)
 
     @staticmethod
-    def get_definitions():
-        chambers = {}
+    def connect():
+        db = sqlite3.connect(Chambers.make_registry_path(), timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS chambers (handle TEXT PRIMARY KEY, definition TEXT NOT NULL)")
+        with Chambers.import_lock:
+            if not Chambers.imported:
+                Chambers.import_chamber_files(db)
+                Chambers.imported = True
+        return db
+
+    @staticmethod
+    def rescan():
+        # Import .chamber files added or rewritten since, on the next connect
+        with Chambers.import_lock:
+            Chambers.imported = False
+
+    @staticmethod
+    def import_chamber_files(db):
         for chamber_filename in Chambers.get_chamber_files():
+            handle = os.path.splitext(os.path.basename(chamber_filename))[0]
             try:
                 with open(chamber_filename) as f:
-                    log.info(f"Loading {chamber_filename}")
-                    json_text = f.read()
-                    handle = os.path.splitext(os.path.basename(chamber_filename))[0]
-                    chambers[handle] = json.loads(json_text)
+                    log.info(f"Importing {chamber_filename}")
+                    definition = json.loads(f.read())
+                if not Chambers.is_valid(definition):
+                    log.error(f"Not importing {chamber_filename}, it needs {', '.join(Chambers.required_keys)}")
+                    continue
+                # A file for a chamber that is already registered replaces it
+                db.execute("INSERT OR REPLACE INTO chambers (handle, definition) VALUES (?, ?)",
+                           (handle, json.dumps(definition)))
+                os.replace(chamber_filename, f"{chamber_filename}.imported")
             except Exception as e:
-                log.exception(f"Loading {handle} failed, skipping.", exc_info=e)
-        return chambers
+                log.exception(f"Importing {handle} failed, skipping.", exc_info=e)
+
+    @staticmethod
+    def get_definitions():
+        db = Chambers.connect()
+        try:
+            chambers = {}
+            for handle, definition in db.execute("SELECT handle, definition FROM chambers"):
+                try:
+                    chambers[handle] = json.loads(definition)
+                except Exception as e:
+                    log.exception(f"Loading {handle} failed, skipping.", exc_info=e)
+            return chambers
+        finally:
+            db.close()
+
+    @staticmethod
+    def has_any():
+        # Without loading any definitions
+        db = Chambers.connect()
+        try:
+            return bool(db.execute("SELECT EXISTS(SELECT 1 FROM chambers)").fetchone()[0])
+        finally:
+            db.close()
+
+    @staticmethod
+    def get(handle):
+        db = Chambers.connect()
+        try:
+            row = db.execute("SELECT definition FROM chambers WHERE handle = ?", (handle,)).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            db.close()
 
     @staticmethod
     def delete(handle):
         log.info(f"Deleting {handle}")
-        os.unlink(Chambers.make_chamber_file_path(handle))
+        db = Chambers.connect()
+        try:
+            db.execute("DELETE FROM chambers WHERE handle = ?", (handle,))
+        finally:
+            db.close()
 
     @staticmethod
     def create(handle, username, password, hostname):
-        if handle in Chambers.get_definitions():
-            raise Exception(f"Chamber {handle} already exists")
-        chamber_filename = Chambers.make_chamber_file_path(handle)
-        with open(chamber_filename, "w") as f:
-            log.info(f"Writing {chamber_filename}")
-            json_text = json.dumps({
+        db = Chambers.connect()
+        try:
+            log.info(f"Registering {handle}")
+            db.execute("INSERT INTO chambers (handle, definition) VALUES (?, ?)", (handle, json.dumps({
                 "username": username,
                 "app_password": password,
                 "hostname": hostname
-            })
-            f.write(json_text)
+            })))
+        except sqlite3.IntegrityError:
+            raise Exception(f"Chamber {handle} already exists")
+        finally:
+            db.close()
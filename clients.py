@@ -0,0 +1,169 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, json, base64, asyncio, logging
+from threading import Lock
+import httpx
+from atproto import Client, AsyncClient, IdResolver, AsyncIdResolver
+from atproto_client.request import RequestBase, Request, AsyncRequest
+from outbound import SendScheduler
+
+log = logging.getLogger("echochamber.clients")
+
+class HandleCache:
+    # handle -> DID, remembered for `ttl` seconds. Only filled by the
+    # resolver, never by what members send, which anyone can make up.
+
+    @staticmethod
+    def get_default_ttl():
+        return float(os.environ.get("ECHOCHAMBER_HANDLE_TTL", "3600"))
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else HandleCache.get_default_ttl()
+        self.dids = {}
+        self.lock = Lock()
+
+    def get(self, handle):
+        with self.lock:
+            entry = self.dids.get(handle)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            return None
+
+    def remember(self, handle, did):
+        if handle and did:
+            with self.lock:
+                self.dids[handle] = (did, time.monotonic() + self.ttl)
+
+    def resolve(self, handle):
+        did = self.get(handle)
+        if did is None:
+            did = ClientRegistry.get_id_resolver().handle.resolve(handle)
+            self.remember(handle, did)
+        return did
+
+    async def resolve_async(self, handle):
+        did = self.get(handle)
+        if did is None:
+            did = await ClientRegistry.get_async_id_resolver().handle.resolve(handle)
+            self.remember(handle, did)
+        return did
+
+class ClientRegistry:
+    # Process wide HTTP plumbing. Every Client for the same hostname shares
+    # one httpx connection pool, and all bots share one IdResolver and one
+    # HandleCache. Each Client keeps its own auth headers, as atproto keeps
+    # those in the Request wrapper rather than in the pool.
+
+    http_clients = {}
+    async_http_clients = {}
+    request_classes = {}
+    id_resolver = None
+    async_id_resolver = None
+    handles = HandleCache()
+    lock = Lock()
+
+    @staticmethod
+    def get_limits():
+        return httpx.Limits(
+            max_connections=int(os.environ.get("ECHOCHAMBER_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("ECHOCHAMBER_HTTP_MAX_KEEPALIVE", "20")),
+        )
+
+    @staticmethod
+    def get_account(request):
+        # The DID in the access token a request was made with
+        try:
+            token = request.headers["authorization"].split()[-1]
+            payload = token.split(".")[1]
+            return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["sub"]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def make_response_hook(hostname):
+        scheduler = SendScheduler.for_host(hostname)
+        def on_response(response):
+            # Only the send limits matter to the outbound scheduler, and
+            # they are kept per account
+            if response.request.url.path.endswith("chat.bsky.convo.sendMessage"):
+                account = ClientRegistry.get_account(response.request)
+                if account:
+                    scheduler.observe_headers(account, response.headers)
+        return on_response
+
+    @staticmethod
+    def get_http_client(hostname):
+        with ClientRegistry.lock:
+            http_client = ClientRegistry.http_clients.get(hostname)
+            if http_client is None:
+                hook = ClientRegistry.make_response_hook(hostname)
+                http_client = httpx.Client(
+                    follow_redirects=True,
+                    limits=ClientRegistry.get_limits(),
+                    event_hooks={"response": [hook]},
+                )
+                ClientRegistry.http_clients[hostname] = http_client
+            return http_client
+
+    @staticmethod
+    def get_async_http_client(hostname):
+        # httpx.AsyncClient is bound to the event loop that uses it
+        key = (hostname, id(asyncio.get_running_loop()))
+        with ClientRegistry.lock:
+            http_client = ClientRegistry.async_http_clients.get(key)
+            if http_client is None:
+                hook = ClientRegistry.make_response_hook(hostname)
+                async def on_response(response):
+                    hook(response)
+                http_client = httpx.AsyncClient(
+                    follow_redirects=True,
+                    limits=ClientRegistry.get_limits(),
+                    event_hooks={"response": [on_response]},
+                )
+                ClientRegistry.async_http_clients[key] = http_client
+            return http_client
+
+    @staticmethod
+    def get_request_class(hostname, base_class, get_pool):
+        # atproto clones requests with a bare constructor call, so the pool is
+        # bound to a per-host subclass instead of passed in
+        key = (hostname, base_class)
+        with ClientRegistry.lock:
+            request_class = ClientRegistry.request_classes.get(key)
+            if request_class is None:
+                def __init__(self):
+                    # Skips base_class.__init__, which opens an httpx client
+                    # of its own that would never be used or closed
+                    RequestBase.__init__(self)
+                    self._client = get_pool(hostname)
+                request_class = type(f"Shared{base_class.__name__}", (base_class,), {"__init__": __init__})
+                ClientRegistry.request_classes[key] = request_class
+            return request_class
+
+    @staticmethod
+    def make_client(hostname):
+        request_class = ClientRegistry.get_request_class(hostname, Request, ClientRegistry.get_http_client)
+        return Client(hostname, request=request_class())
+
+    @staticmethod
+    def make_async_client(hostname):
+        request_class = ClientRegistry.get_request_class(hostname, AsyncRequest, ClientRegistry.get_async_http_client)
+        return AsyncClient(hostname, request=request_class())
+
+    @staticmethod
+    def get_id_resolver():
+        with ClientRegistry.lock:
+            if ClientRegistry.id_resolver is None:
+                ClientRegistry.id_resolver = IdResolver()
+            return ClientRegistry.id_resolver
+
+    @staticmethod
+    def get_async_id_resolver():
+        with ClientRegistry.lock:
+            if ClientRegistry.async_id_resolver is None:
+                ClientRegistry.async_id_resolver = AsyncIdResolver()
+            return ClientRegistry.async_id_resolver
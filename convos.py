@@ -0,0 +1,87 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, json, logging
+from threading import Lock
+
+log = logging.getLogger("echochamber.convos")
+
+class ConvoStore:
+    # DID -> convo_id for one chamber, persisted in the data directory so a
+    # restarted bot can message its members without looking up every convo
+    # again. The file is read on first use, and writes are batched: the
+    # store is flushed every `flush_every` changes, after `flush_interval`
+    # seconds, or when the bot stops.
+
+    @staticmethod
+    def make_convo_file_path(handle):
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/{handle}.convos"
+
+    def __init__(self, handle, flush_every=50, flush_interval=30):
+        self.handle = handle
+        self.filename = ConvoStore.make_convo_file_path(handle)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.convo_ids = None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def load(self):
+        if self.convo_ids is not None:
+            return
+        self.convo_ids = {}
+        try:
+            with open(self.filename) as f:
+                self.convo_ids = json.load(f)
+            log.info(f"Loaded {len(self.convo_ids)} convos for {self.handle}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.exception(f"Loading {self.filename} failed, starting empty", exc_info=e)
+
+    def get(self, did):
+        with self.lock:
+            self.load()
+            return self.convo_ids.get(did)
+
+    def __contains__(self, did):
+        return self.get(did) is not None
+
+    def put(self, did, convo_id):
+        with self.lock:
+            self.load()
+            if self.convo_ids.get(did) == convo_id:
+                return
+            self.convo_ids[did] = convo_id
+            self.pending += 1
+            if self.pending >= self.flush_every or \
+               time.monotonic() - self.last_flush > self.flush_interval:
+                self.write()
+
+    def forget(self, did):
+        with self.lock:
+            self.load()
+            if self.convo_ids.pop(did, None) is not None:
+                self.pending += 1
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.write()
+
+    def write(self):
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump(self.convo_ids, f)
+            os.replace(tmp_filename, self.filename)
+            log.debug(f"Wrote {len(self.convo_ids)} convos for {self.handle}")
+        except Exception as e:
+            log.exception(f"Writing {self.filename} failed", exc_info=e)
+        self.pending = 0
+        self.last_flush = time.monotonic()
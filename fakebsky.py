@@ -0,0 +1,398 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+# A local stand-in for the parts of BlueSky that Echochamber talks to:
+# login, chat.bsky.convo.getLog, sendMessage, getConvoForMembers and
+# app.bsky.graph.getFollowers. Used by bench.py, not for production.
+
+import re, json, time, base64, bisect, random, hashlib, logging, argparse
+from threading import Thread, Lock
+from collections import Counter, defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger("echochamber.fakebsky")
+
+BENCH_MARKER = re.compile(r"\[bench:(\d+)\]")
+
+def now_iso():
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{int(time.time() * 1000) % 1000:03d}Z"
+
+def make_jwt(did, scope, lifetime):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    now = int(time.time())
+    payload = {"scope": scope, "sub": did, "aud": "did:web:fakebsky.local",
+               "iat": now, "exp": now + lifetime, "jti": f"{random.getrandbits(64):x}"}
+    return f"{encode({'alg': 'ES256K', 'typ': 'JWT'})}.{encode(payload)}.fakesig"
+
+class XrpcError(Exception):
+    def __init__(self, status, error, message="", headers=None):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+        self.message = message
+        self.headers = headers or {}
+
+class Account:
+    def __init__(self, handle, password, display_name=None):
+        self.did = "did:plc:" + hashlib.sha256(handle.encode()).hexdigest()[:24]
+        self.handle = handle
+        self.password = password
+        self.display_name = display_name
+        self.followers = []
+        self.send_tokens = None
+        self.send_updated = time.monotonic()
+
+    def profile(self):
+        profile = {"did": self.did, "handle": self.handle}
+        if self.display_name:
+            profile["displayName"] = self.display_name
+        return profile
+
+class FakeWorld:
+    # Accounts, follows, convos and per-account chat logs, plus counters for
+    # what the bench wants to know afterwards.
+
+    def __init__(self, latency=0.0, jitter=0.0, send_rate=None, page_size=50):
+        self.latency = latency
+        self.jitter = jitter
+        self.send_rate = send_rate
+        self.page_size = page_size
+        self.lock = Lock()
+        self.accounts = {}
+        self.by_did = {}
+        self.tokens = {}
+        self.convos = {}
+        self.convo_members = {}
+        self.logs = defaultdict(list)
+        self.rev = 0
+        self.calls = Counter()
+        self.posted = {}
+        self.latencies = []
+        self.deliveries = Counter()
+        self.follow_rkeys = {}
+        self.listeners = []
+
+    def next_rev(self):
+        self.rev += 1
+        return f"{self.rev:016d}"
+
+    def add_account(self, handle, password="password", display_name=None):
+        with self.lock:
+            account = Account(handle, password, display_name)
+            self.accounts[handle] = account
+            self.by_did[account.did] = account
+            return account
+
+    def follow(self, follower, subject):
+        with self.lock:
+            if follower.did in subject.followers:
+                return
+            subject.followers.append(follower.did)
+            rkey = self.follow_rkeys[(follower.did, subject.did)] = self.next_rev()
+        self.emit_follow(follower, "create", rkey, {"$type": "app.bsky.graph.follow",
+                                                    "subject": subject.did, "createdAt": now_iso()})
+
+    def unfollow(self, follower, subject):
+        with self.lock:
+            if follower.did not in subject.followers:
+                return
+            subject.followers.remove(follower.did)
+            rkey = self.follow_rkeys.pop((follower.did, subject.did), None)
+        self.emit_follow(follower, "delete", rkey or self.next_rev(), None)
+
+    def emit_follow(self, follower, operation, rkey, record):
+        # Jetstream shaped commit event, for FakeJetstream subscribers
+        commit = {"rev": self.next_rev(), "operation": operation,
+                  "collection": "app.bsky.graph.follow", "rkey": rkey}
+        if record:
+            commit["record"] = record
+        event = json.dumps({"did": follower.did, "time_us": int(time.time() * 1_000_000),
+                            "kind": "commit", "commit": commit})
+        for listener in list(self.listeners):
+            listener(event)
+
+    def get_convo(self, dids, announce=True):
+        key = frozenset(dids)
+        convo_id = self.convos.get(key)
+        if convo_id is None:
+            convo_id = f"convo{len(self.convos):08d}"
+            self.convos[key] = convo_id
+            self.convo_members[convo_id] = sorted(key)
+            if announce:
+                for did in key:
+                    self.logs[did].append({"$type": "chat.bsky.convo.defs#logBeginConvo",
+                                           "rev": self.next_rev(), "convoId": convo_id})
+        return convo_id
+
+    def open_convos(self, chamber):
+        # Convos that already exist before the bot starts
+        with self.lock:
+            for did in chamber.followers:
+                self.get_convo([chamber.did, did], announce=False)
+
+    def append_message(self, convo_id, sender_did, text, facets=None):
+        message = {"$type": "chat.bsky.convo.defs#messageView",
+                   "id": f"msg{self.rev + 1:012d}", "rev": self.next_rev(),
+                   "text": text, "sender": {"did": sender_did}, "sentAt": now_iso()}
+        if facets:
+            message["facets"] = facets
+        for did in self.convo_members[convo_id]:
+            self.logs[did].append({"$type": "chat.bsky.convo.defs#logCreateMessage",
+                                   "rev": message["rev"], "convoId": convo_id, "message": message})
+        return message
+
+    def post(self, member, chamber, text):
+        # A member types a message in the chamber's chat
+        with self.lock:
+            convo_id = self.get_convo([member.did, chamber.did])
+            match = BENCH_MARKER.search(text)
+            if match:
+                self.posted[match.group(1)] = time.monotonic()
+            return self.append_message(convo_id, member.did, text)
+
+    def delivered(self, recipient_did, text):
+        # A coalesced DM carries several markers
+        for marker in BENCH_MARKER.findall(text):
+            if marker in self.posted:
+                self.latencies.append(time.monotonic() - self.posted[marker])
+                self.deliveries[marker] += 1
+
+    def take_send_token(self, account):
+        if not self.send_rate:
+            return
+        now = time.monotonic()
+        if account.send_tokens is None:
+            account.send_tokens = self.send_rate
+        account.send_tokens = min(self.send_rate, account.send_tokens + (now - account.send_updated) * self.send_rate)
+        account.send_updated = now
+        if account.send_tokens < 1:
+            reset = int(time.time() + (1 - account.send_tokens) / self.send_rate) + 1
+            raise XrpcError(429, "RateLimitExceeded", "Rate Limit Exceeded", {
+                "ratelimit-limit": str(int(self.send_rate)),
+                "ratelimit-remaining": "0",
+                "ratelimit-reset": str(reset),
+            })
+        account.send_tokens -= 1
+
+    def authenticate(self, headers):
+        token = (headers.get("Authorization") or "").removeprefix("Bearer ").strip()
+        with self.lock:
+            did = self.tokens.get(token)
+        if did is None:
+            raise XrpcError(401, "InvalidToken", "Token could not be verified")
+        return self.by_did[did]
+
+    def new_session(self, account):
+        access = make_jwt(account.did, "com.atproto.access", 3600)
+        refresh = make_jwt(account.did, "com.atproto.refresh", 30 * 24 * 3600)
+        with self.lock:
+            self.tokens[access] = account.did
+            self.tokens[refresh] = account.did
+        return {"accessJwt": access, "refreshJwt": refresh, "handle": account.handle,
+                "did": account.did, "active": True}
+
+    # XRPC methods
+
+    def create_session(self, headers, params, body):
+        account = self.accounts.get(body.get("identifier"))
+        if not account or account.password != body.get("password"):
+            raise XrpcError(401, "AuthenticationRequired", "Invalid identifier or password")
+        return self.new_session(account)
+
+    def refresh_session(self, headers, params, body):
+        return self.new_session(self.authenticate(headers))
+
+    def get_profile(self, headers, params, body):
+        self.authenticate(headers)
+        actor = params.get("actor", [""])[0]
+        account = self.by_did.get(actor) or self.accounts.get(actor)
+        if not account:
+            raise XrpcError(400, "InvalidRequest", "Profile not found")
+        return account.profile()
+
+    def resolve_handle(self, headers, params, body):
+        account = self.accounts.get(params.get("handle", [""])[0])
+        if not account:
+            raise XrpcError(400, "InvalidRequest", "Unable to resolve handle")
+        return {"did": account.did}
+
+    def get_followers(self, headers, params, body):
+        self.authenticate(headers)
+        actor = params.get("actor", [""])[0]
+        subject = self.by_did.get(actor) or self.accounts.get(actor)
+        if not subject:
+            raise XrpcError(400, "InvalidRequest", "Profile not found")
+        start = int(params.get("cursor", ["0"])[0] or 0)
+        limit = int(params.get("limit", [str(self.page_size)])[0])
+        with self.lock:
+            page = subject.followers[start:start + limit]
+            more = start + limit < len(subject.followers)
+        reply = {"subject": subject.profile(),
+                 "followers": [self.by_did[did].profile() for did in page]}
+        if more:
+            reply["cursor"] = str(start + limit)
+        return reply
+
+    def get_log(self, headers, params, body):
+        account = self.authenticate(headers)
+        cursor = params.get("cursor", [None])[0]
+        with self.lock:
+            events = self.logs[account.did]
+            if cursor is None:
+                page = events[-100:]
+            else:
+                start = bisect.bisect_right(events, cursor, key=lambda event: event["rev"])
+                page = events[start:start + 100]
+        reply = {"logs": page}
+        if page:
+            reply["cursor"] = page[-1]["rev"]
+        elif cursor:
+            reply["cursor"] = cursor
+        return reply
+
+    def get_convo_for_members(self, headers, params, body):
+        account = self.authenticate(headers)
+        members = params.get("members", [])
+        with self.lock:
+            convo_id = self.get_convo(members)
+            return {"convo": {"id": convo_id, "rev": self.next_rev(),
+                              "members": [self.by_did[did].profile() for did in members if did in self.by_did],
+                              "muted": False, "unreadCount": 0}}
+
+    def send_message(self, headers, params, body):
+        account = self.authenticate(headers)
+        convo_id = body.get("convoId")
+        text = body.get("message", {}).get("text", "")
+        with self.lock:
+            self.take_send_token(account)
+            if convo_id not in self.convo_members or account.did not in self.convo_members[convo_id]:
+                raise XrpcError(400, "InvalidConvo", "Convo not found")
+            message = self.append_message(convo_id, account.did, text, body.get("message", {}).get("facets"))
+            for did in self.convo_members[convo_id]:
+                if did != account.did:
+                    self.delivered(did, text)
+        return message
+
+    methods = {
+        "com.atproto.server.createSession": create_session,
+        "com.atproto.server.refreshSession": refresh_session,
+        "com.atproto.identity.resolveHandle": resolve_handle,
+        "app.bsky.actor.getProfile": get_profile,
+        "app.bsky.graph.getFollowers": get_followers,
+        "chat.bsky.convo.getLog": get_log,
+        "chat.bsky.convo.getConvoForMembers": get_convo_for_members,
+        "chat.bsky.convo.sendMessage": send_message,
+    }
+
+    def call(self, nsid, headers, params, body):
+        with self.lock:
+            self.calls[nsid] += 1
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        method = FakeWorld.methods.get(nsid)
+        if method is None:
+            raise XrpcError(501, "MethodNotImplemented", f"{nsid} not implemented")
+        return method(self, headers, params, body)
+
+class XrpcHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    world = None
+
+    def handle_xrpc(self, body):
+        url = urlparse(self.path)
+        nsid = url.path.rstrip("/").split("/")[-1]
+        try:
+            reply = self.world.call(nsid, self.headers, parse_qs(url.query), body)
+            status, headers = 200, {}
+        except XrpcError as e:
+            reply = {"error": e.error, "message": e.message}
+            status, headers = e.status, e.headers
+        data = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_xrpc({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        self.handle_xrpc(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+class FakeBsky:
+    def __init__(self, world, port=0):
+        handler = type("BoundXrpcHandler", (XrpcHandler,), {"world": world})
+        self.world = world
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True, name="fakebsky").start()
+        log.info(f"Fake BlueSky listening on {self.url}")
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+
+class FakeJetstream:
+    # Minimal stand-in for a Jetstream /subscribe endpoint, forwards the
+    # follow events of a FakeWorld to every connected websocket.
+
+    def __init__(self, world, port=0):
+        from websockets.sync.server import serve
+        self.world = world
+        self.server = serve(self.handle, "127.0.0.1", port)
+        self.url = f"ws://127.0.0.1:{self.server.socket.getsockname()[1]}/subscribe"
+
+    def handle(self, websocket):
+        def send(event):
+            try:
+                websocket.send(event)
+            except Exception:
+                pass
+        self.world.listeners.append(send)
+        try:
+            for message in websocket:
+                pass
+        finally:
+            self.world.listeners.remove(send)
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True, name="fakejetstream").start()
+        log.info(f"Fake Jetstream listening on {self.url}")
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the BlueSky APIs used by Echochamber")
+    parser.add_argument("--port", type=int, default=2583)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--send-rate", type=float, default=None, help="sendMessage calls/s per account")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeBsky(FakeWorld(latency=args.latency, send_rate=args.send_rate), args.port)
+    print(f"Listening on {fake.url}")
+    fake.server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, logging, asyncio
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import ERRORS
+
+log = logging.getLogger("echochamber.fanout")
+
+class FanOutReport:
+    def __init__(self, name):
+        self.name = name
+        self.delivered = []
+        self.failed = {}
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def success(self, did):
+        self.delivered.append(did)
+
+    def failure(self, did, e):
+        self.failed[did] = e
+        ERRORS.inc(type(e).__name__)
+        log.warning("FanOut %s: delivery to %s failed, %r", self.name, did, e)
+
+    def done(self):
+        self.duration = time.monotonic() - self.started
+        return self
+
+    def __str__(self):
+        return f"{len(self.delivered)} delivered, {len(self.failed)} failed in {self.duration:.2f}s"
+
+class FanOut:
+    # Sends one message to many recipients, at most `concurrency` at a time.
+    # Each recipient succeeds or fails on its own; a failing or slow convo
+    # only ties up one of the workers.
+    #
+    # The worker threads are shared by every chamber in the process, a
+    # semaphore per chamber keeps each to its own `concurrency`. A send only
+    # reaches the pool once it holds the semaphore, so a busy chamber never
+    # parks shared workers waiting for it.
+
+    executor = None
+    executor_lock = Lock()
+
+    @staticmethod
+    def get_default_concurrency():
+        return int(os.environ.get("ECHOCHAMBER_FANOUT_CONCURRENCY", "8"))
+
+    @staticmethod
+    def get_pool_size():
+        return int(os.environ.get("ECHOCHAMBER_FANOUT_WORKERS", "64"))
+
+    @staticmethod
+    def get_executor():
+        with FanOut.executor_lock:
+            if FanOut.executor is None:
+                FanOut.executor = ThreadPoolExecutor(
+                    max_workers=FanOut.get_pool_size(),
+                    thread_name_prefix="fanout")
+            return FanOut.executor
+
+    def __init__(self, name, concurrency=None):
+        self.name = name
+        self.concurrency = max(1, int(concurrency or FanOut.get_default_concurrency()))
+        self.semaphore = BoundedSemaphore(self.concurrency)
+
+    def send_one_guarded(self, send_one, did):
+        try:
+            return send_one(did)
+        finally:
+            self.semaphore.release()
+
+    def send(self, recipients, send_one):
+        report = FanOutReport(self.name)
+        recipients = list(recipients)
+        if not recipients:
+            return report.done()
+        executor = FanOut.get_executor()
+        futures = {}
+        for did in recipients:
+            self.semaphore.acquire()
+            futures[executor.submit(self.send_one_guarded, send_one, did)] = did
+        for future in as_completed(futures):
+            did = futures[future]
+            try:
+                future.result()
+                report.success(did)
+            except Exception as e:
+                report.failure(did, e)
+        return report.done()
+
+    def send_inline(self, recipients, send_one):
+        # On the calling thread, for callers that must not queue behind
+        # the pool, like replies while a broadcast is under way
+        report = FanOutReport(self.name)
+        for did in recipients:
+            try:
+                send_one(did)
+                report.success(did)
+            except Exception as e:
+                report.failure(did, e)
+        return report.done()
+
+    async def send_async(self, recipients, send_one):
+        report = FanOutReport(self.name)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def send_guarded(did):
+            async with semaphore:
+                try:
+                    await send_one(did)
+                    report.success(did)
+                except Exception as e:
+                    report.failure(did, e)
+        await asyncio.gather(*[send_guarded(did) for did in recipients])
+        return report.done()
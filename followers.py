@@ -0,0 +1,148 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, logging
+from collections import defaultdict
+
+log = logging.getLogger("echochamber.followers")
+
+class Member:
+    # What a chamber keeps of a follower's profile. The atproto ProfileView
+    # models are dropped as soon as a listing has been read.
+    __slots__ = ("did", "handle", "display_name")
+
+    def __init__(self, did, handle, display_name=None):
+        self.did = did
+        self.handle = handle
+        self.display_name = display_name or None
+
+    @staticmethod
+    def from_profile(profile):
+        return Member(profile.did, profile.handle, profile.display_name)
+
+    def same_as(self, profile):
+        return self.handle == profile.handle and self.display_name == (profile.display_name or None)
+
+    def __repr__(self):
+        return f"Member({self.did!r}, {self.handle!r}, {self.display_name!r})"
+
+class MemberSearch:
+    # Substring search over member DIDs, handles and display names.
+    #
+    # Every member's fields are split into trigrams, and a word of three or
+    # more characters only needs to be checked against members that have all
+    # of its trigrams. Shorter words are rare and fall back to a scan.
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i+3] for i in range(len(text) - 2)}
+
+    def __init__(self):
+        self.texts = {}
+        self.grams = defaultdict(set)
+
+    def add(self, did, *fields):
+        self.remove(did)
+        text = "\n".join(field for field in fields if field)
+        self.texts[did] = text
+        for gram in MemberSearch.trigrams(text):
+            self.grams[gram].add(did)
+
+    def remove(self, did):
+        text = self.texts.pop(did, None)
+        if text is None:
+            return
+        for gram in MemberSearch.trigrams(text):
+            dids = self.grams[gram]
+            dids.discard(did)
+            if not dids:
+                del self.grams[gram]
+
+    def search(self, word):
+        if not word:
+            return set()
+        if len(word) < 3:
+            return {did for did, text in self.texts.items() if word in text}
+        postings = sorted((self.grams.get(gram, set()) for gram in MemberSearch.trigrams(word)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return {did for did in candidates if word in self.texts[did]}
+
+class FollowerCache:
+    # The follower set of one chamber, keyed by DID.
+    #
+    # Listing followers is many API round trips for a large chamber, so the
+    # set is reused until it is older than the TTL or someone invalidates it
+    # (a convo begun or left, a mute).
+    #
+    # Display names and the search index are kept in step with the set, so
+    # name lookups are O(1) and /who-is does not scan every member.
+
+    @staticmethod
+    def get_default_ttl():
+        return float(os.environ.get("ECHOCHAMBER_FOLLOWERS_TTL", "300"))
+
+    def __init__(self, name, ttl=None):
+        self.name = name
+        self.ttl = ttl if ttl is not None else FollowerCache.get_default_ttl()
+        self.members = {}
+        self.names = {}
+        self.search_index = MemberSearch()
+        self.fetched_at = None
+
+    def is_stale(self):
+        if self.fetched_at is None:
+            return True
+        return time.monotonic() - self.fetched_at > self.ttl
+
+    def invalidate(self):
+        self.fetched_at = None
+
+    @staticmethod
+    def display_name_of(follower):
+        return follower.display_name if follower.display_name else follower.handle
+
+    def replace(self, followers):
+        # Unchanged members keep their Member, only new or renamed ones are
+        # built and reindexed
+        members = {}
+        for follower in followers:
+            old = self.members.get(follower.did)
+            if old is not None and old.same_as(follower):
+                members[follower.did] = old
+            else:
+                members[follower.did] = self.index(Member.from_profile(follower))
+        for did in self.members.keys() - members.keys():
+            self.unindex(did)
+        self.members = members
+        self.fetched_at = time.monotonic()
+        log.debug(f"FollowerCache {self.name}: {len(self.members)} followers")
+
+    def add(self, follower):
+        old = self.members.get(follower.did)
+        if old is None or not old.same_as(follower):
+            self.members[follower.did] = self.index(Member.from_profile(follower))
+
+    def discard(self, did):
+        if self.members.pop(did, None) is not None:
+            self.unindex(did)
+
+    def index(self, member):
+        self.names[member.did] = FollowerCache.display_name_of(member)
+        self.search_index.add(member.did, member.did, member.handle, member.display_name)
+        return member
+
+    def unindex(self, did):
+        self.names.pop(did, None)
+        self.search_index.remove(did)
+
+    def name_of(self, did, default=None):
+        return self.names.get(did, default)
+
+    def search(self, words):
+        matches = set()
+        for word in words:
+            matches |= self.search_index.search(word)
+        return [self.members[did] for did in matches if did in self.members]
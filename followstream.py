@@ -0,0 +1,134 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, json, random, logging
+from threading import Thread, Lock
+from collections import OrderedDict
+from urllib.parse import urlencode
+from metrics import ERRORS
+
+log = logging.getLogger("echochamber.followstream")
+
+FOLLOW_COLLECTION = "app.bsky.graph.follow"
+
+class FollowStream:
+    # Optional follower tracking from a Jetstream style event stream.
+    #
+    # One thread per process subscribes to app.bsky.graph.follow commits and
+    # hands follows and unfollows that target a running chamber to that
+    # chamber, which applies them to its FollowerCache on its next poll.
+    # Unfollows only carry the record key, so the keys of follows seen on the
+    # stream are remembered. An unfollow of an older follow invalidates the
+    # caches of the chambers the follower is in. The regular full listing
+    # still runs every ECHOCHAMBER_FOLLOW_RECONCILE seconds as a safety net.
+    #
+    # Enabled by setting ECHOCHAMBER_FOLLOW_STREAM to the subscribe URL, e.g.
+    # wss://jetstream2.us-east.bsky.network/subscribe
+
+    bots = {}
+    bots_lock = Lock()
+    stream = None
+
+    @staticmethod
+    def get_url():
+        return os.environ.get("ECHOCHAMBER_FOLLOW_STREAM")
+
+    @staticmethod
+    def is_enabled():
+        return bool(FollowStream.get_url())
+
+    @staticmethod
+    def get_reconcile_interval():
+        return float(os.environ.get("ECHOCHAMBER_FOLLOW_RECONCILE", "3600"))
+
+    @staticmethod
+    def register(bot):
+        with FollowStream.bots_lock:
+            FollowStream.bots[bot.did] = bot
+
+    @staticmethod
+    def unregister(bot):
+        with FollowStream.bots_lock:
+            if FollowStream.bots.get(bot.did) is bot:
+                del FollowStream.bots[bot.did]
+
+    @staticmethod
+    def start():
+        if not FollowStream.is_enabled() or FollowStream.stream:
+            return FollowStream.stream
+        FollowStream.stream = FollowStream(FollowStream.get_url())
+        Thread(target=FollowStream.stream.run, daemon=True, name="followstream").start()
+        return FollowStream.stream
+
+    def __init__(self, url, max_rkeys=100000):
+        self.url = url
+        self.cursor = None
+        self.stop = False
+        self.max_rkeys = max_rkeys
+        self.rkeys = OrderedDict()
+
+    def make_url(self):
+        params = [("wantedCollections", FOLLOW_COLLECTION)]
+        if self.cursor:
+            # Rewind a little, replayed events are idempotent
+            params.append(("cursor", str(self.cursor - 5_000_000)))
+        separator = "&" if "?" in self.url else "?"
+        return f"{self.url}{separator}{urlencode(params)}"
+
+    def run(self):
+        from websockets.sync.client import connect
+        backoff = 1
+        while not self.stop:
+            try:
+                with connect(self.make_url(), max_size=2**20) as websocket:
+                    log.info(f"Follow stream connected to {self.url}")
+                    backoff = 1
+                    for message in websocket:
+                        if self.stop:
+                            break
+                        self.handle_message(message)
+            except Exception as e:
+                ERRORS.inc(type(e).__name__)
+                log.warning(f"Follow stream {self.url} failed, {e!r}, retrying in {backoff}s")
+            if not self.stop:
+                time.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, 60)
+
+    def handle_message(self, message):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        self.cursor = event.get("time_us", self.cursor)
+        commit = event.get("commit")
+        if event.get("kind") != "commit" or not commit or commit.get("collection") != FOLLOW_COLLECTION:
+            return
+        follower_did = event.get("did")
+        rkey = (follower_did, commit.get("rkey"))
+        if commit.get("operation") == "create":
+            subject_did = (commit.get("record") or {}).get("subject")
+            bot = FollowStream.bots.get(subject_did)
+            if bot:
+                self.remember(rkey, subject_did)
+                bot.queue_follow_change("follow", follower_did)
+        elif commit.get("operation") == "delete":
+            subject_did = self.rkeys.pop(rkey, None)
+            if subject_did:
+                bot = FollowStream.bots.get(subject_did)
+                if bot:
+                    bot.queue_follow_change("unfollow", follower_did)
+                return
+            # A follow from before we were listening, check who had them
+            with FollowStream.bots_lock:
+                bots = list(FollowStream.bots.values())
+            for bot in bots:
+                if follower_did in bot.followers:
+                    bot.queue_follow_change("unknown", follower_did)
+
+    def remember(self, rkey, subject_did):
+        self.rkeys[rkey] = subject_did
+        while len(self.rkeys) > self.max_rkeys:
+            self.rkeys.popitem(last=False)
@@ -0,0 +1,96 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, atexit, logging
+from threading import Lock
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+log = logging.getLogger("echochamber.logpipe")
+
+# Per message and per recipient lines from the relay, high volume
+RELAY_LOGGER = "echochamber.relay"
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock QueueHandler formats every record on the calling thread.
+    # Hand the record over untouched instead, so formatting and the disk
+    # write both happen on the listener thread. Log arguments should be
+    # values that are not mutated afterwards.
+    def prepare(self, record):
+        return record
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per logger. Records over the limit are dropped before
+    # their message is formatted, and the number dropped is reported on the
+    # next record that gets through.
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.dropped = 0
+        self.lock = Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1 and record.levelno < logging.WARNING:
+                self.dropped += 1
+                return False
+            self.tokens = max(0.0, self.tokens - 1)
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.msg = f"[{dropped} suppressed] {str(record.msg)}"
+        return True
+
+class LogPipe:
+    listener = None
+
+    @staticmethod
+    def is_enabled():
+        return os.environ.get("ECHOCHAMBER_LOG_QUEUE", "1") not in ("0", "false", "no")
+
+    @staticmethod
+    def get_rate_limits():
+        # ECHOCHAMBER_LOG_RATE="echochamber.relay=20,echochamber.fanout=5"
+        # in records per second, 0 turns a logger's limit off
+        spec = os.environ.get("ECHOCHAMBER_LOG_RATE", f"{RELAY_LOGGER}=20")
+        limits = {}
+        for item in spec.split(","):
+            name, _, rate = item.strip().partition("=")
+            try:
+                limits[name] = float(rate)
+            except ValueError:
+                log.warning(f"Ignoring log rate limit {item!r}")
+        return limits
+
+    @staticmethod
+    def apply_rate_limits():
+        for name, rate in LogPipe.get_rate_limits().items():
+            if rate > 0:
+                logging.getLogger(name).addFilter(RateLimitFilter(rate))
+
+    @staticmethod
+    def start(handlers):
+        # Moves the given root handlers behind a queue drained by one
+        # background writer thread
+        root = logging.getLogger()
+        queue = SimpleQueue()
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(DeferredQueueHandler(queue))
+        LogPipe.listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        LogPipe.listener.start()
+        atexit.register(LogPipe.stop)
+
+    @staticmethod
+    def stop():
+        if LogPipe.listener:
+            LogPipe.listener.stop()
+            LogPipe.listener = None
@@ -0,0 +1,114 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, json, datetime, logging
+from collections import OrderedDict
+
+log = logging.getLogger("echochamber.logstate")
+
+class SeenMessages:
+    # Bounded dedup window of relayed message ids, each with when it was sent.
+    #
+    # Ids are evicted oldest first once there are more than `max_count`, or
+    # when they are older than `max_age` seconds. The newest send time
+    # evicted so far is kept as a watermark, and a message sent at or before
+    # it, or before the age window, counts as seen, so an evicted id can
+    # never be relayed a second time.
+
+    def __init__(self, max_count=2000, max_age=24*3600):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.ids = OrderedDict()
+        self.watermark = 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def add(self, message_id, when=None):
+        self.ids[message_id] = when if when is not None else time.time()
+        self.ids.move_to_end(message_id)
+        self.prune()
+
+    def prune(self):
+        horizon = time.time() - self.max_age
+        while self.ids and (len(self.ids) > self.max_count or next(iter(self.ids.values())) < horizon):
+            _, when = self.ids.popitem(last=False)
+            self.watermark = max(self.watermark, when)
+
+    def check_and_add(self, message_id, sent_at=None):
+        # True if the message has not been seen before
+        if message_id in self.ids:
+            return False
+        if sent_at is not None and (sent_at <= self.watermark or sent_at < time.time() - self.max_age):
+            return False
+        self.add(message_id, sent_at)
+        return True
+
+class LogState:
+    # Where a chamber is in its chat log: the get_log cursor and the recently
+    # relayed message ids, saved under ECHOCHAMBER_DATADIR so a restarted bot
+    # resumes where it stopped instead of re-relaying old entries.
+
+    @staticmethod
+    def make_logstate_file_path(handle):
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/{handle}.logstate"
+
+    @staticmethod
+    def parse_sent_at(sent_at):
+        try:
+            return datetime.datetime.fromisoformat(sent_at).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.filename = LogState.make_logstate_file_path(handle)
+        self.cursor = None
+        self.seen = SeenMessages()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+            self.cursor = state.get("cursor")
+            self.seen.watermark = state.get("watermark", 0.0)
+            for message_id, when in state.get("seen", []):
+                self.seen.add(message_id, when)
+            log.info(f"Resuming {self.handle} at cursor {self.cursor}, {len(self.seen)} recent messages")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.exception(f"Loading {self.filename} failed, starting from scratch", exc_info=e)
+
+    def advance(self, cursor):
+        if cursor and cursor != self.cursor:
+            self.cursor = cursor
+            self.dirty = True
+
+    def is_new_message(self, message):
+        if not self.seen.check_and_add(message.id, LogState.parse_sent_at(message.sent_at)):
+            return False
+        self.dirty = True
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump({"cursor": self.cursor, "watermark": self.seen.watermark,
+                           "seen": list(self.seen.ids.items())}, f)
+            os.replace(tmp_filename, self.filename)
+            self.dirty = False
+        except Exception as e:
+            log.exception(f"Writing {self.filename} failed", exc_info=e)
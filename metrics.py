@@ -0,0 +1,186 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, logging, threading
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger("echochamber.metrics")
+
+class Metric:
+    registry = []
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @staticmethod
+    def format_labels(labelnames, labelvalues, extra=None):
+        pairs = list(zip(labelnames, labelvalues))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{Metric.escape(value)}"' for name, value in pairs) + "}"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+        Metric.registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labelvalues, value in self.values.items():
+                lines.append(f"{self.name}{Metric.format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.functions = {}
+
+    def set(self, *labelvalues, value):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def set_function(self, function, *labelvalues):
+        # Evaluated each time the metrics are scraped
+        with self.lock:
+            self.functions[labelvalues] = function
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for labelvalues, function in functions.items():
+            try:
+                values[labelvalues] = function()
+            except Exception as e:
+                log.debug(f"Gauge {self.name} failed, {e}")
+        for labelvalues, value in values.items():
+            lines.append(f"{self.name}{Metric.format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+    latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    size_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, name, help, labelnames=(), buckets=latency_buckets):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labelvalues, value):
+        with self.lock:
+            entry = self.values.get(labelvalues)
+            if entry is None:
+                entry = self.values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labelvalues, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = Metric.format_labels(self.labelnames, labelvalues, ("le", bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = Metric.format_labels(self.labelnames, labelvalues, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = Metric.format_labels(self.labelnames, labelvalues)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render_all():
+    lines = []
+    for metric in Metric.registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Per chamber hot path
+GET_LOG_SECONDS = Histogram("echochamber_get_log_seconds",
+    "Latency of chat.bsky.convo.getLog polls", ["chamber"])
+EVENTS_PER_POLL = Histogram("echochamber_events_per_poll",
+    "Log events returned per poll", ["chamber"], Histogram.size_buckets)
+FANOUT_SECONDS = Histogram("echochamber_fanout_seconds",
+    "Time to deliver one broadcast to all recipients", ["chamber"])
+BROADCAST_RECIPIENTS = Histogram("echochamber_broadcast_recipients",
+    "Recipients per broadcast", ["chamber"], Histogram.size_buckets)
+PHASE_SECONDS = Histogram("echochamber_phase_seconds",
+    "Time spent per phase of polling and relaying", ["chamber", "phase"])
+API_CALLS = Counter("echochamber_api_calls_total",
+    "BlueSky API calls", ["chamber", "endpoint"])
+
+# Process wide
+RECONNECTS = Counter("echochamber_reconnects_total",
+    "Reconnects to the BlueSky host", ["reason"])
+ERRORS = Counter("echochamber_errors_total",
+    "Errors by exception class", ["exception"])
+ADMIN_QUEUE_DEPTH = Gauge("echochamber_admin_queue_depth",
+    "Messages waiting in the super admin queue")
+THREADS = Gauge("echochamber_threads",
+    "Live threads in the process")
+BOTS = Gauge("echochamber_bots",
+    "Running echochambers")
+THREADS.set_function(threading.active_count)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_all().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+class MetricsServer:
+    @staticmethod
+    def get_port():
+        port = os.environ.get("ECHOCHAMBER_METRICS_PORT")
+        return int(port) if port else None
+
+    @staticmethod
+    def start():
+        # Serves /metrics on localhost when ECHOCHAMBER_METRICS_PORT is set
+        port = MetricsServer.get_port()
+        if not port:
+            return None
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        server.daemon_threads = True
+        thread = Thread(target=server.serve_forever, daemon=True, name="metrics")
+        thread.start()
+        log.info(f"Metrics on http://127.0.0.1:{port}/metrics")
+        return server
@@ -8,6 +8,10 @@ class ShutdownMsg:
     def __init__(self, handle):
         self.handle = handle
 
+class ReconcileMsg:
+    # Chamber definitions in the data directory have changed
+    handle = None
+
 class StartupMsg:
     def __init__(self, handle, username, password, hostname):
         self.handle   = handle
@@ -0,0 +1,89 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, logging
+from threading import Lock
+
+log = logging.getLogger("echochamber.mutes")
+
+class MuteList:
+    # The muted DIDs of this server, one set shared by every chamber in the
+    # process. A mute is visible to all chambers at once, and edits made to
+    # muted_users.txt by hand are picked up when its mtime changes (checked
+    # at most every `check_interval` seconds).
+
+    shared_list = None
+    shared_lock = Lock()
+
+    @staticmethod
+    def shared():
+        with MuteList.shared_lock:
+            if MuteList.shared_list is None:
+                MuteList.shared_list = MuteList(MuteList.get_muted_users_filename())
+            return MuteList.shared_list
+
+    @staticmethod
+    def get_muted_users_filename():
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/muted_users.txt"
+
+    def __init__(self, filename, check_interval=5):
+        self.filename = filename
+        self.check_interval = check_interval
+        self.dids = set()
+        self.mtime = None
+        self.checked = 0.0
+        self.lock = Lock()
+        self.reload()
+
+    def __contains__(self, did):
+        self.refresh()
+        return did in self.dids
+
+    def __iter__(self):
+        self.refresh()
+        return iter(list(self.dids))
+
+    def __len__(self):
+        self.refresh()
+        return len(self.dids)
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        if self.get_mtime() != self.mtime:
+            self.reload()
+
+    def reload(self):
+        with self.lock:
+            muted_users = set()
+            self.mtime = self.get_mtime()
+            try:
+                with open(self.filename, "r") as f:
+                    for didstr in f:
+                        did = didstr.strip()
+                        if did and did[0] != "#":
+                            muted_users.add(did)
+            except FileNotFoundError:
+                pass
+            self.dids = muted_users
+        log.info(f"Muted users: {len(muted_users)} loaded from {self.filename}")
+
+    def mute(self, target_did, issuer_did):
+        with self.lock:
+            self.dids.add(target_did)
+            with open(self.filename, "a") as f:
+                print(f"# User {issuer_did} muted {target_did} on {time.ctime()}\n{target_did}", file=f)
+            self.mtime = self.get_mtime()
+        log.info(f"{issuer_did} muted user {target_did}")
@@ -0,0 +1,165 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, logging, asyncio
+from threading import Lock
+import atproto_client.exceptions
+
+log = logging.getLogger("echochamber.outbound")
+
+PRIORITY_REPLY = 0
+PRIORITY_BROADCAST = 1
+
+class RateLimited(Exception):
+    pass
+
+class SendScheduler:
+    # Paces send_message calls to one BlueSky host, shared by every chamber
+    # on that host.
+    #
+    # BlueSky limits sends per account, so a 429, or a response that says
+    # the limit is used up, only holds back the account it was for, until
+    # the server says it resets. A steady cap for the whole host is opt-in:
+    # with ECHOCHAMBER_SEND_RATE set, a token bucket sets the rate, and lower
+    # priority senders hold back while any higher priority sender waits for
+    # a token, so admin replies overtake queued broadcast traffic.
+
+    schedulers = {}
+    schedulers_lock = Lock()
+
+    @staticmethod
+    def for_host(hostname):
+        with SendScheduler.schedulers_lock:
+            scheduler = SendScheduler.schedulers.get(hostname)
+            if not scheduler:
+                scheduler = SendScheduler(hostname)
+                SendScheduler.schedulers[hostname] = scheduler
+            return scheduler
+
+    @staticmethod
+    def get_default_rate():
+        # 0 leaves the host uncapped
+        return float(os.environ.get("ECHOCHAMBER_SEND_RATE", "0"))
+
+    @staticmethod
+    def get_default_burst():
+        return float(os.environ.get("ECHOCHAMBER_SEND_BURST", "20"))
+
+    @staticmethod
+    def get_status_code(e):
+        return getattr(getattr(e, "response", None), "status_code", None)
+
+    def __init__(self, hostname, rate=None, burst=None, retries=3):
+        self.hostname = hostname
+        self.rate = rate if rate is not None else SendScheduler.get_default_rate()
+        self.burst = burst or SendScheduler.get_default_burst()
+        self.retries = retries
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = {}
+        self.waiting = [0, 0]
+        self.lock = Lock()
+
+    def blocked_for(self, account):
+        # How long sends from the account are held back
+        with self.lock:
+            return self.blocked_until.get(account, 0.0) - time.monotonic()
+
+    def try_acquire(self, priority):
+        # Returns 0 when a token was taken, otherwise how long to wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if any(self.waiting[:priority]):
+                return 1 / self.rate
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def enter(self, priority):
+        with self.lock:
+            self.waiting[priority] += 1
+
+    def leave(self, priority):
+        with self.lock:
+            self.waiting[priority] -= 1
+
+    def acquire(self, priority, account):
+        while (wait := self.blocked_for(account)) > 0:
+            time.sleep(wait)
+        if not self.rate:
+            return
+        self.enter(priority)
+        try:
+            while (wait := self.try_acquire(priority)) > 0:
+                time.sleep(wait)
+        finally:
+            self.leave(priority)
+
+    async def acquire_async(self, priority, account):
+        while (wait := self.blocked_for(account)) > 0:
+            await asyncio.sleep(wait)
+        if not self.rate:
+            return
+        self.enter(priority)
+        try:
+            while (wait := self.try_acquire(priority)) > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self.leave(priority)
+
+    def observe_headers(self, account, headers):
+        # Honour ratelimit-* and retry-after headers from the host
+        if not headers:
+            return
+        headers = {k.lower(): v for k, v in headers.items()}
+        delay = None
+        try:
+            if "retry-after" in headers:
+                delay = float(headers["retry-after"])
+            elif headers.get("ratelimit-remaining") == "0" and "ratelimit-reset" in headers:
+                delay = float(headers["ratelimit-reset"]) - time.time()
+        except ValueError:
+            pass
+        if delay and delay > 0:
+            self.block(account, delay)
+
+    def block(self, account, delay):
+        with self.lock:
+            until = time.monotonic() + delay
+            if until > self.blocked_until.get(account, 0.0):
+                self.blocked_until[account] = until
+                log.warning(f"Rate limited by {self.hostname} for {account}, holding its sends for {delay:.1f}s")
+
+    def on_rate_limited(self, account, e):
+        headers = getattr(e.response, "headers", None)
+        self.observe_headers(account, headers)
+        if self.blocked_for(account) <= 0:
+            self.block(account, 10)
+
+    def call(self, priority, account, fn, *args):
+        for attempt in range(self.retries + 1):
+            self.acquire(priority, account)
+            try:
+                return fn(*args)
+            except atproto_client.exceptions.RequestErrorBase as e:
+                if SendScheduler.get_status_code(e) != 429:
+                    raise
+                self.on_rate_limited(account, e)
+        raise RateLimited(f"Rate limited by {self.hostname} for {account}, gave up after {self.retries} retries")
+
+    async def call_async(self, priority, account, fn, *args):
+        for attempt in range(self.retries + 1):
+            await self.acquire_async(priority, account)
+            try:
+                return await fn(*args)
+            except atproto_client.exceptions.RequestErrorBase as e:
+                if SendScheduler.get_status_code(e) != 429:
+                    raise
+                self.on_rate_limited(account, e)
+        raise RateLimited(f"Rate limited by {self.hostname} for {account}, gave up after {self.retries} retries")
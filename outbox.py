@@ -0,0 +1,185 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, json, random, logging
+from threading import Lock
+from collections import OrderedDict
+
+log = logging.getLogger("echochamber.outbox")
+
+class OutboxBatch:
+    # One message to a set of recipients. Each recipient has a delivery
+    # key of its own, <batch key>:<did>, and its own retry schedule.
+    def __init__(self, key, priority, message):
+        self.key = key
+        self.priority = priority
+        self.message = message
+        self.attempts = {}
+        self.retry_at = {}
+
+    def due(self, now):
+        return [did for did in self.attempts if self.retry_at.get(did, 0) <= now]
+
+class Outbox:
+    # Deliveries a chamber has promised but not yet made, in an append-only
+    # journal in the data directory. The poll loop adds a batch per message
+    # and returns; a delivery worker takes due deliveries, and records each one
+    # as done when sent, when it runs out of attempts, or when the host
+    # refuses it in a way retrying will not change. On start the
+    # journal is replayed, so a crash or restart loses nothing. A delivery
+    # may be made twice if the process dies between sending and recording.
+    #
+    # Delivery keys that are done are remembered, so adding the same
+    # message again, e.g. after replaying a log page, does not send it twice.
+    # The journal is rewritten with only the open deliveries and the
+    # remembered keys once it has grown by `compact_after` records.
+
+    @staticmethod
+    def make_outbox_file_path(handle):
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/{handle}.outbox"
+
+    @staticmethod
+    def get_default_max_attempts():
+        return int(os.environ.get("ECHOCHAMBER_OUTBOX_ATTEMPTS", "6"))
+
+    def __init__(self, handle, max_attempts=None, compact_after=2000, remember=10000):
+        self.handle = handle
+        self.filename = Outbox.make_outbox_file_path(handle)
+        self.max_attempts = max_attempts or Outbox.get_default_max_attempts()
+        self.compact_after = compact_after
+        self.remember = remember
+        self.batches = OrderedDict()
+        self.done = OrderedDict()
+        self.records = 0
+        self.file = None
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        self.replay(json.loads(line))
+                    except ValueError:
+                        # Torn last line from a crash
+                        log.warning(f"Skipping unreadable outbox record in {self.filename}")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.exception(f"Loading {self.filename} failed, starting empty", exc_info=e)
+        if len(self):
+            log.info(f"Outbox for {self.handle} has {len(self)} undelivered messages")
+        self.compact()
+
+    def replay(self, record):
+        if "put" in record:
+            batch = self.batches.get(record["put"])
+            if not batch:
+                batch = self.batches[record["put"]] = OutboxBatch(record["put"], record["priority"], record["message"])
+            for did in record["to"]:
+                if f"{batch.key}:{did}" not in self.done:
+                    batch.attempts[did] = 0
+        elif "done" in record:
+            self.forget(record["done"], record["to"])
+
+    def forget(self, key, did):
+        batch = self.batches.get(key)
+        if batch:
+            batch.attempts.pop(did, None)
+            batch.retry_at.pop(did, None)
+            if not batch.attempts:
+                del self.batches[key]
+        self.done[f"{key}:{did}"] = True
+        while len(self.done) > self.remember:
+            self.done.popitem(last=False)
+
+    def append(self, record):
+        if self.file is None:
+            self.file = open(self.filename, "a")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.records += 1
+        if self.records >= self.compact_after:
+            self.compact()
+
+    def compact(self):
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                for key in self.done:
+                    batch_key, _, did = key.partition(":")
+                    f.write(json.dumps({"done": batch_key, "to": did}) + "\n")
+                for batch in self.batches.values():
+                    f.write(json.dumps({"put": batch.key, "priority": batch.priority,
+                                        "message": batch.message, "to": list(batch.attempts)}) + "\n")
+            if self.file:
+                self.file.close()
+                self.file = None
+            os.replace(tmp_filename, self.filename)
+        except Exception as e:
+            log.exception(f"Compacting {self.filename} failed", exc_info=e)
+        self.records = 0
+
+    def add(self, key, priority, message, recipients):
+        with self.lock:
+            batch = self.batches.get(key)
+            new = [did for did in recipients
+                   if f"{key}:{did}" not in self.done and (not batch or did not in batch.attempts)]
+            if not new:
+                return 0
+            if not batch:
+                batch = self.batches[key] = OutboxBatch(key, priority, message)
+            for did in new:
+                batch.attempts[did] = 0
+            self.append({"put": key, "priority": priority, "message": message, "to": new})
+            return len(new)
+
+    def due(self, priority):
+        # Batches of the given priority, oldest first, with the recipients
+        # whose delivery may be tried now
+        now = time.monotonic()
+        with self.lock:
+            due = [(batch, batch.due(now)) for batch in self.batches.values() if batch.priority == priority]
+        return [(batch, dids) for batch, dids in due if dids]
+
+    def next_due(self):
+        # Seconds until the next delivery may be tried, None when empty
+        now = time.monotonic()
+        with self.lock:
+            retry_at = [batch.retry_at.get(did, 0) for batch in self.batches.values() for did in batch.attempts]
+        if not retry_at:
+            return None
+        return max(0.0, min(retry_at) - now)
+
+    def delivered(self, key, did):
+        with self.lock:
+            self.forget(key, did)
+            self.append({"done": key, "to": did})
+
+    def failed(self, key, did, permanent=False):
+        # A permanent failure is dropped at once instead of retried
+        with self.lock:
+            batch = self.batches.get(key)
+            if not batch or did not in batch.attempts:
+                return
+            attempts = batch.attempts[did] = batch.attempts[did] + 1
+            if permanent or attempts >= self.max_attempts:
+                log.error(f"Outbox for {self.handle} giving up on {key} to {did} after {attempts} attempts")
+                self.forget(key, did)
+                self.append({"done": key, "to": did, "dropped": True})
+                return
+            batch.retry_at[did] = time.monotonic() + min(300, 2 ** attempts) * random.uniform(0.5, 1.5)
+
+    def __len__(self):
+        return sum(len(batch.attempts) for batch in self.batches.values())
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
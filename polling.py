@@ -0,0 +1,49 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, random, zlib, logging
+
+log = logging.getLogger("echochamber.polling")
+
+class PollScheduler:
+    # Decides how long a chamber waits between get_log polls.
+    #
+    # Any activity drops the interval to the floor, every idle poll doubles
+    # it up to the ceiling. Each chamber starts at its own phase (derived
+    # from the handle) and every interval is jittered, so chambers on the
+    # same host drift apart instead of polling in lockstep.
+
+    @staticmethod
+    def get_floor():
+        return float(os.environ.get("ECHOCHAMBER_POLL_MIN", "3"))
+
+    @staticmethod
+    def get_ceiling():
+        return float(os.environ.get("ECHOCHAMBER_POLL_MAX", "120"))
+
+    @staticmethod
+    def get_jitter():
+        return float(os.environ.get("ECHOCHAMBER_POLL_JITTER", "0.2"))
+
+    def __init__(self, name, floor=None, ceiling=None, backoff=2.0, jitter=None):
+        self.name = name
+        self.floor = floor if floor is not None else PollScheduler.get_floor()
+        self.ceiling = max(self.floor, ceiling if ceiling is not None else PollScheduler.get_ceiling())
+        self.backoff = backoff
+        self.jitter = jitter if jitter is not None else PollScheduler.get_jitter()
+        self.interval = self.floor
+
+    def initial_delay(self):
+        phase = zlib.crc32(self.name.encode("utf-8")) / 0xffffffff
+        return phase * self.floor
+
+    def next_interval(self, activity):
+        if activity:
+            self.interval = self.floor
+        else:
+            self.interval = min(self.ceiling, self.interval * self.backoff)
+        spread = self.interval * self.jitter
+        return max(0.0, self.interval + random.uniform(-spread, spread))
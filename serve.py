@@ -4,13 +4,22 @@
 # (C) 2025 All For Eco AB, Jan Lindblad
 # See LICENSE for license conditions
 
-import logging, time, os, datetime
-from threading import Thread
+import logging, time, os, datetime, asyncio
+from threading import Thread, Lock
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from bot import BlueSkyBot
-from msgs import ShutdownMsg, StartupMsg
+from asyncbot import AsyncBlueSkyBot
+from msgs import ShutdownMsg, StartupMsg, ReconcileMsg
 from chambers import Chambers
+from sessions import SessionStore
+from metrics import MetricsServer, ADMIN_QUEUE_DEPTH, BOTS
+from followstream import FollowStream
+from logpipe import LogPipe
+from shards import Supervisor, get_shard_count
+from breaker import CircuitBreaker
+from watcher import DataDirWatcher
 
 # Load environment variables
 load_dotenv()
@@ -32,11 +41,22 @@ def setup_logging():
     ecfh = logging.FileHandler(f'{logdir}/echochamber.log')
     ecfh.setFormatter(formatter)
     eclog = logging.getLogger("echochamber")
-    eclog.addHandler(ecfh)
     eclog.setLevel(logging.INFO)
+    LogPipe.apply_rate_limits()
+    if LogPipe.is_enabled():
+        # Both files are written from one background thread
+        ecfh.addFilter(logging.Filter("echochamber"))
+        LogPipe.start(list(logging.getLogger().handlers) + [ecfh])
+    else:
+        eclog.addHandler(ecfh)
 
     Hourglass.start()
 
+def setup_metrics(queue):
+    ADMIN_QUEUE_DEPTH.set_function(queue.qsize)
+    BOTS.set_function(BlueSkyBot.get_bot_count)
+    MetricsServer.start()
+
 class Hourglass(Thread):
     def __init__(self):
         super().__init__()
@@ -73,35 +93,331 @@ class Hourglass(Thread):
                 log.info(f"### Hourglass turning {time.ctime()}")
                 time.sleep(30)
 
+def handle_admin_msg(queue, msg, shard=None):
+    if isinstance(msg, ShutdownMsg):
+        Chambers.delete(msg.handle)
+        SessionStore(msg.handle).clear()
+    if isinstance(msg, StartupMsg):
+        try:
+            Chambers.create(msg.handle, msg.username, msg.password, msg.hostname)        
+            BlueSkyBot(queue, msg.handle, msg.username, msg.password, msg.hostname).start()
+        except Exception as e:
+            log.exception(f"Could not create echochamber {msg.handle}, skipping", exc_info=e)
+    if isinstance(msg, ReconcileMsg):
+        try:
+            stop, start = reconcile_chambers(shard)
+            replace_chambers(queue, stop, start)
+        except Exception as e:
+            log.exception(f"Could not reconcile echochambers, keeping them as they are", exc_info=e)
+
+def get_reconcile_enabled():
+    return os.environ.get("ECHOCHAMBER_RECONCILE", "1") not in ("0", "false", "no")
+
+def get_reconcile_interval():
+    return float(os.environ.get("ECHOCHAMBER_RECONCILE_SCAN", "5"))
+
+def watch_chambers(deliver):
+    # Asks the admin loop to reconcile when the definitions change, so
+    # reconciling never races a /startup or /shutdown being handled
+    datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+    watcher = DataDirWatcher(datadir, get_reconcile_interval())
+    log.info(f"Watching {datadir} for chamber changes")
+    while True:
+        try:
+            watcher.wait()
+            deliver(ReconcileMsg())
+        except Exception as e:
+            log.exception(f"Watching {datadir} failed, trying again", exc_info=e)
+            time.sleep(get_reconcile_interval())
+
+def start_chamber_watcher(deliver):
+    if get_reconcile_enabled():
+        Thread(target=watch_chambers, args=[deliver], daemon=True, name="reconcile").start()
+
+def chamber_changed(bot, chamber):
+    return (bot.username, bot.password, bot.hostname, bot.fanout_concurrency) != \
+           (chamber['username'], chamber['app_password'], chamber['hostname'], chamber.get('fanout_concurrency'))
+
+def reconcile_chambers(shard=None):
+    # Returns the running bots to stop, for chambers that are gone from the
+    # registry or have changed, and the definitions of chambers to start:
+    # new ones, and changed ones once their old bot has stopped
+    Chambers.rescan()
+    definitions = Chambers.get_definitions()
+    if shard:
+        definitions = {handle: chamber for handle, chamber in definitions.items() if shard.owns(handle)}
+    invalid = [handle for handle, chamber in definitions.items() if not Chambers.is_valid(chamber)]
+    for handle in invalid:
+        # Leave the chamber as it is rather than stop it over a bad row
+        log.error(f"Echochamber {handle} has an incomplete definition, not reconciling it")
+        del definitions[handle]
+    running = dict(BlueSkyBot.running_bots)
+    stop = []
+    for handle, bot in running.items():
+        if handle not in definitions and handle not in invalid:
+            log.info(f"Echochamber {handle} removed, stopping")
+            stop.append(bot)
+    start = {}
+    for handle, chamber in definitions.items():
+        bot = running.get(handle)
+        if bot is None:
+            log.info(f"Echochamber {handle} added, starting")
+            start[handle] = chamber
+        elif chamber_changed(bot, chamber):
+            log.info(f"Echochamber {handle} changed, restarting")
+            stop.append(bot)
+            start[handle] = chamber
+    return stop, start
+
+def replace_chambers(queue, stop, start):
+    # All old bots wind down at the same time
+    for bot in stop:
+        bot.request_stop()
+    for bot in stop:
+        bot.shutdown()
+        if bot.handle in start:
+            # The old bot can no longer save its session over this
+            SessionStore(bot.handle).clear()
+    if start:
+        start_chambers(queue, start)
+
+async def replace_chambers_async(queue, stop, start):
+    await asyncio.gather(*[bot.shutdown() for bot in stop])
+    for bot in stop:
+        if bot.handle in start:
+            SessionStore(bot.handle).clear()
+    if start:
+        await start_chambers_async(queue, start)
+
 def handle_admin_msgs(queue):
     while True:
         if not BlueSkyBot.get_bot_count():
             log.info("All echochambers have shutdown, terminating")
             break
+        handle_admin_msg(queue, queue.get())
+
+async def handle_admin_msg_async(queue, msg, shard=None):
+    if isinstance(msg, ShutdownMsg):
+        Chambers.delete(msg.handle)
+        SessionStore(msg.handle).clear()
+    if isinstance(msg, StartupMsg):
+        try:
+            Chambers.create(msg.handle, msg.username, msg.password, msg.hostname)
+            bot = await AsyncBlueSkyBot.create(queue, msg.handle, msg.username, msg.password, msg.hostname)
+            bot.start()
+        except Exception as e:
+            log.exception(f"Could not create echochamber {msg.handle}, skipping", exc_info=e)
+    if isinstance(msg, ReconcileMsg):
+        try:
+            stop, start = reconcile_chambers(shard)
+            await replace_chambers_async(queue, stop, start)
+        except Exception as e:
+            log.exception(f"Could not reconcile echochambers, keeping them as they are", exc_info=e)
+
+async def handle_admin_msgs_async(queue):
+    while True:
+        if not BlueSkyBot.get_bot_count():
+            log.info("All echochambers have shutdown, terminating")
+            break
+        await handle_admin_msg_async(queue, await queue.get())
+
+def handle_shard_msgs(queue, shard):
+    # A shard keeps running with no chambers, the supervisor may route
+    # new ones to it. Startups for other shards go back to the supervisor.
+    while True:
         msg = queue.get()
-        if isinstance(msg, ShutdownMsg):
-            Chambers.delete(msg.handle)
-        if isinstance(msg, StartupMsg):
+        if msg is None:
+            break
+        if msg.handle and not shard.owns(msg.handle):
+            shard.outbox.put(msg)
+            continue
+        handle_admin_msg(queue, msg, shard)
+
+async def handle_shard_msgs_async(queue, shard):
+    while True:
+        msg = await queue.get()
+        if msg is None:
+            break
+        if msg.handle and not shard.owns(msg.handle):
+            shard.outbox.put(msg)
+            continue
+        await handle_admin_msg_async(queue, msg, shard)
+
+def get_runtime():
+    # "threads" runs one thread per chamber, "asyncio" runs all chambers
+    # as coroutines on a single event loop
+    return os.environ.get("ECHOCHAMBER_RUNTIME", "threads")
+
+def get_startup_workers():
+    return int(os.environ.get("ECHOCHAMBER_STARTUP_WORKERS", "8"))
+
+class StartupProgress:
+    # Counts chambers as they come up during a parallel startup
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.lock = Lock()
+
+    def report(self, handle, chamber_started, error=None):
+        with self.lock:
+            self.done += 1
+            if error:
+                self.failed += 1
+            done = self.done
+        elapsed = time.monotonic() - chamber_started
+        if error:
+            log.error(f"Could not create echochamber {handle} ({done}/{self.total}, {elapsed:.1f}s), skipping", exc_info=error)
+        else:
+            log.info(f"Echochamber {handle} listening ({done}/{self.total}, {elapsed:.1f}s)")
+
+    def summary(self):
+        return f"{self.done - self.failed}/{self.total} echochambers started, {self.failed} failed, in {time.monotonic() - self.started:.1f}s"
+
+def start_chamber(queue, handle, chamber, progress):
+    chamber_started = time.monotonic()
+    try:
+        BlueSkyBot(queue, handle, chamber['username'], chamber['app_password'], chamber['hostname'],
+                   chamber.get('fanout_concurrency')).start()
+        progress.report(handle, chamber_started)
+    except Exception as e:
+        progress.report(handle, chamber_started, e)
+
+def start_chambers(queue, chambers):
+    # Each bot starts listening as soon as it has connected
+    progress = StartupProgress(len(chambers))
+    with ThreadPoolExecutor(max_workers=get_startup_workers(), thread_name_prefix="startup") as executor:
+        for handle, chamber in chambers.items():
+            executor.submit(start_chamber, queue, handle, chamber, progress)
+    log.info(progress.summary())
+
+async def start_chamber_async(queue, handle, chamber, progress, semaphore):
+    async with semaphore:
+        chamber_started = time.monotonic()
+        try:
+            bot = await AsyncBlueSkyBot.create(queue, handle, chamber['username'], chamber['app_password'],
+                                               chamber['hostname'], chamber.get('fanout_concurrency'))
+            bot.start()
+            progress.report(handle, chamber_started)
+        except Exception as e:
+            progress.report(handle, chamber_started, e)
+
+async def start_chambers_async(queue, chambers):
+    progress = StartupProgress(len(chambers))
+    semaphore = asyncio.Semaphore(get_startup_workers())
+    await asyncio.gather(*[start_chamber_async(queue, handle, chamber, progress, semaphore)
+                           for handle, chamber in chambers.items()])
+    log.info(progress.summary())
+
+def get_watchdog_interval():
+    return float(os.environ.get("ECHOCHAMBER_WATCHDOG_INTERVAL", "30"))
+
+def watch_bots():
+    # Restarts chambers whose bot thread died, each once its host's
+    # circuit breaker lets it through
+    while True:
+        time.sleep(get_watchdog_interval())
+        for bot in BlueSkyBot.get_dead_bots():
+            breaker = CircuitBreaker.for_host(bot.hostname)
+            breaker.wait()
+            log.error(f"Echochamber {bot.handle} died, restarting")
+            try:
+                bot.restart()
+                breaker.success()
+            except Exception as e:
+                breaker.failure()
+                log.exception(f"Could not restart echochamber {bot.handle}", exc_info=e)
+
+def start_watchdog():
+    Thread(target=watch_bots, daemon=True, name="watchdog").start()
+
+async def watch_bots_async():
+    while True:
+        await asyncio.sleep(get_watchdog_interval())
+        for bot in BlueSkyBot.get_dead_bots():
+            breaker = CircuitBreaker.for_host(bot.hostname)
+            await breaker.wait_async()
+            log.error(f"Echochamber {bot.handle} died, restarting")
             try:
-                Chambers.create(msg.handle, msg.username, msg.password, msg.hostname)        
-                BlueSkyBot(queue, msg.handle, msg.username, msg.password, msg.hostname).start()
+                await bot.restart()
+                breaker.success()
             except Exception as e:
-                log.exception(f"Could not create echochamber {msg.handle}, skipping", exc_info=e)
-    
+                breaker.failure()
+                log.exception(f"Could not restart echochamber {bot.handle}", exc_info=e)
+
+def get_shard_chambers(shard):
+    return {handle: chamber for handle, chamber in Chambers.get_definitions().items()
+            if shard.owns(handle)}
+
+def has_chambers():
+    return Chambers.has_any()
+
+async def run_shard_async(shard):
+    super_admin_msg_queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    shard.forward(lambda msg: loop.call_soon_threadsafe(super_admin_msg_queue.put_nowait, msg))
+    start_chamber_watcher(lambda msg: loop.call_soon_threadsafe(super_admin_msg_queue.put_nowait, msg))
+    setup_metrics(super_admin_msg_queue)
+    await start_chambers_async(super_admin_msg_queue, get_shard_chambers(shard))
+    watchdog = asyncio.create_task(watch_bots_async())
+    await handle_shard_msgs_async(super_admin_msg_queue, shard)
+    watchdog.cancel()
+
+def run_shard(shard):
+    # Entry point of a supervisor worker process
+    setup_logging()
+    log.info(f"### Echochamber shard {shard.index}/{shard.count} starting on {time.ctime()}")
+    metrics_port = os.environ.get("ECHOCHAMBER_METRICS_PORT")
+    if metrics_port:
+        # Shards serve their metrics on consecutive ports from the one given
+        os.environ["ECHOCHAMBER_METRICS_PORT"] = str(int(metrics_port) + shard.index)
+    FollowStream.start()
+    if get_runtime() == "asyncio":
+        asyncio.run(run_shard_async(shard))
+    else:
+        super_admin_msg_queue = Queue()
+        shard.forward(super_admin_msg_queue.put)
+        start_chamber_watcher(super_admin_msg_queue.put)
+        setup_metrics(super_admin_msg_queue)
+        start_chambers(super_admin_msg_queue, get_shard_chambers(shard))
+        start_watchdog()
+        handle_shard_msgs(super_admin_msg_queue, shard)
+    log.info(f"### Echochamber shard {shard.index}/{shard.count} terminating on {time.ctime()}")
+
+async def main_async():
+    super_admin_msg_queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    start_chamber_watcher(lambda msg: loop.call_soon_threadsafe(super_admin_msg_queue.put_nowait, msg))
+    setup_metrics(super_admin_msg_queue)
+    await start_chambers_async(super_admin_msg_queue, Chambers.get_definitions())
+    watchdog = asyncio.create_task(watch_bots_async())
+
+    log.info(f"### Echochamber listening on {time.ctime()} (asyncio)")
+    print("Listening...")
+    await handle_admin_msgs_async(super_admin_msg_queue)
+    watchdog.cancel()
+
 def main():
     setup_logging()
     log.info(f"\n\n### Echochamber starting on {time.ctime()}")
+    shard_count = get_shard_count()
+    if shard_count > 1:
+        Supervisor(shard_count, run_shard, has_chambers).run()
+        log.info(f"### Echochamber terminating on {time.ctime()}")
+        return
+
+    FollowStream.start()
+    if get_runtime() == "asyncio":
+        asyncio.run(main_async())
+        log.info(f"### Echochamber terminating on {time.ctime()}")
+        return
 
     super_admin_msg_queue = Queue()
-    chambers = Chambers.get_definitions()
-    for handle in chambers.keys():
-        try:
-            username = chambers[handle]['username']
-            app_password = chambers[handle]['app_password']
-            hostname = chambers[handle]['hostname']
-            BlueSkyBot(super_admin_msg_queue, handle, username, app_password, hostname).start()
-        except Exception as e:
-            log.exception(f"Could not create echochamber {handle}, skipping", exc_info=e)
+    start_chamber_watcher(super_admin_msg_queue.put)
+    setup_metrics(super_admin_msg_queue)
+    start_chambers(super_admin_msg_queue, Chambers.get_definitions())
+    start_watchdog()
 
     log.info(f"### Echochamber listening on {time.ctime()}")
     print("Listening...")
@@ -0,0 +1,49 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, logging
+
+log = logging.getLogger("echochamber.sessions")
+
+class SessionStore:
+    # The exported atproto session (access and refresh tokens) of one
+    # chamber, kept under ECHOCHAMBER_DATADIR readable by the owner only, so
+    # a restart or reconnect can resume it instead of logging in again.
+
+    @staticmethod
+    def make_session_file_path(handle):
+        datadir = os.environ.get("ECHOCHAMBER_DATADIR", ".")
+        return f"{datadir}/{handle}.session"
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.filename = SessionStore.make_session_file_path(handle)
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Could not read session for {self.handle}, {e}")
+            return None
+
+    def save(self, session_string):
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(session_string)
+            os.replace(tmp_filename, self.filename)
+        except Exception as e:
+            log.exception(f"Could not save session for {self.handle}", exc_info=e)
+
+    def clear(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,125 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, zlib, logging, multiprocessing
+from threading import Thread
+
+log = logging.getLogger("echochamber.shards")
+
+def get_shard_count():
+    # 0 or 1 keeps every chamber in the serving process
+    return int(os.environ.get("ECHOCHAMBER_SHARDS", "0"))
+
+def shard_of(handle, count):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(handle.lower().encode("utf-8")) % count
+
+class Shard:
+    # What a worker process knows about its place in the supervisor. The
+    # inbox carries admin messages routed to this shard, the outbox carries
+    # admin messages for chambers owned by another shard. None in the inbox
+    # tells the worker to stop.
+    def __init__(self, index, count, inbox, outbox):
+        self.index = index
+        self.count = count
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def owns(self, handle):
+        return shard_of(handle, self.count) == self.index
+
+    def forward(self, deliver):
+        # Hands messages from the supervisor to the local admin loop
+        def run():
+            while True:
+                msg = self.inbox.get()
+                deliver(msg)
+                if msg is None:
+                    break
+        Thread(target=run, daemon=True, name=f"shard{self.index}-inbox").start()
+
+class Supervisor:
+    # Runs the chambers in a number of worker processes. Each chamber belongs
+    # to shard_of(handle), StartupMsg and ShutdownMsg are routed to the owning
+    # worker, and a worker that dies is restarted on its own without
+    # touching the other shards.
+
+    min_restart_delay = 1
+    max_restart_delay = 60
+
+    def __init__(self, count, target, has_chambers):
+        self.count = count
+        self.target = target
+        self.has_chambers = has_chambers
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.inboxes = [self.context.Queue() for _ in range(count)]
+        self.processes = [None] * count
+        self.restart_delays = [Supervisor.min_restart_delay] * count
+        self.restart_at = [0.0] * count
+        self.started_at = [0.0] * count
+        self.stop = False
+
+    def start_worker(self, index):
+        shard = Shard(index, self.count, self.inboxes[index], self.outbox)
+        process = self.context.Process(target=self.target, args=(shard,), name=f"echochamber-shard{index}")
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        log.info(f"Shard {index}/{self.count} started as pid {process.pid}")
+
+    def route(self, msg):
+        index = shard_of(msg.handle, self.count)
+        log.info(f"Routing {type(msg).__name__} for {msg.handle} to shard {index}")
+        self.inboxes[index].put(msg)
+
+    def route_messages(self):
+        while not self.stop:
+            msg = self.outbox.get()
+            if msg is None:
+                break
+            self.route(msg)
+
+    def check_workers(self):
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if not self.restart_at[index]:
+                if now - self.started_at[index] > Supervisor.max_restart_delay:
+                    # It ran fine for a while, this is not a crash loop
+                    self.restart_delays[index] = Supervisor.min_restart_delay
+                delay = self.restart_delays[index]
+                log.error(f"Shard {index} pid {process.pid} exited with {process.exitcode}, restarting in {delay}s")
+                self.restart_at[index] = now + delay
+                self.restart_delays[index] = min(delay * 2, Supervisor.max_restart_delay)
+            elif now >= self.restart_at[index]:
+                self.restart_at[index] = 0.0
+                self.start_worker(index)
+
+    def run(self):
+        for index in range(self.count):
+            self.start_worker(index)
+        Thread(target=self.route_messages, daemon=True, name="shard-router").start()
+        try:
+            while not self.stop:
+                time.sleep(2)
+                self.check_workers()
+                if not self.has_chambers():
+                    log.info("All echochambers have shutdown, terminating")
+                    break
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.stop = True
+        self.outbox.put(None)
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
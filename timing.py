@@ -0,0 +1,122 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, sys, time, logging
+from threading import Thread, Lock, get_ident
+from collections import Counter
+from contextlib import contextmanager
+from metrics import PHASE_SECONDS
+
+log = logging.getLogger("echochamber.timing")
+
+class PhaseTimer:
+    # Time spent per phase of the poll loop and of broadcasts, for /stats.
+    # Phases can be timed from fan-out worker threads at the same time.
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.phases = {}
+        self.since = time.monotonic()
+
+    @contextmanager
+    def phase(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, time.monotonic() - started)
+
+    def record(self, phase, seconds):
+        PHASE_SECONDS.observe(self.name, phase, value=seconds)
+        with self.lock:
+            count, total, longest = self.phases.get(phase, (0, 0.0, 0.0))
+            self.phases[phase] = (count + 1, total + seconds, max(longest, seconds))
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.since = time.monotonic()
+
+    def report(self):
+        with self.lock:
+            phases = dict(self.phases)
+            elapsed = time.monotonic() - self.since
+        if not phases:
+            return f"No timings in the last {elapsed:.0f}s"
+        lines = [f"Timings over the last {elapsed:.0f}s:"]
+        for phase, (count, total, longest) in sorted(phases.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{phase}: {count}x avg {total / count * 1000:.0f}ms max {longest * 1000:.0f}ms total {total:.1f}s")
+        return "\n".join(lines)
+
+class SamplingProfiler:
+    # Samples the stacks of every thread in the process at a fixed interval
+    # for a time window and writes them in collapsed stack format, one
+    # "frame;frame;frame count" line per stack, for flamegraph tools.
+    # Opt in with ECHOCHAMBER_PROFILER=1.
+
+    running = None
+    lock = Lock()
+
+    @staticmethod
+    def is_enabled():
+        return os.environ.get("ECHOCHAMBER_PROFILER", "0") not in ("0", "false", "no")
+
+    @staticmethod
+    def get_max_duration():
+        return float(os.environ.get("ECHOCHAMBER_PROFILER_MAX", "300"))
+
+    @staticmethod
+    def start(name, duration, interval=0.01):
+        # Returns the file the profile will be written to, or None when a
+        # profile is already being taken
+        with SamplingProfiler.lock:
+            if SamplingProfiler.running:
+                return None
+            profiler = SamplingProfiler.running = SamplingProfiler(name, min(duration, SamplingProfiler.get_max_duration()), interval)
+        Thread(target=profiler.run, daemon=True, name="profiler").start()
+        return profiler.filename
+
+    def __init__(self, name, duration, interval):
+        logdir = os.environ.get("ECHOCHAMBER_LOGDIR", ".")
+        self.duration = duration
+        self.interval = interval
+        self.filename = f"{logdir}/profile-{name}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        self.stacks = Counter()
+        self.samples = 0
+
+    @staticmethod
+    def format_stack(frame):
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def run(self):
+        own_thread = get_ident()
+        log.info(f"Profiling for {self.duration:.0f}s into {self.filename}")
+        try:
+            deadline = time.monotonic() + self.duration
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        self.stacks[self.format_stack(frame)] += 1
+                self.samples += 1
+                time.sleep(self.interval)
+            self.write()
+            log.info(f"Profile with {self.samples} samples written to {self.filename}")
+        except Exception as e:
+            log.exception(f"Profiling failed", exc_info=e)
+        finally:
+            with SamplingProfiler.lock:
+                SamplingProfiler.running = None
+
+    def write(self):
+        with open(self.filename, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
@@ -0,0 +1,119 @@
+# Echochamber
+#   - Group chats for BlueSky
+#
+# (C) 2025 All For Eco AB, Jan Lindblad
+# See LICENSE for license conditions
+
+import os, time, select, struct, logging, ctypes, ctypes.util
+
+log = logging.getLogger("echochamber.watcher")
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT_HEADER = struct.Struct("iIII")
+
+class DataDirWatcher:
+    # Tells when the chamber definitions in the data directory may have
+    # changed: the registry database, its write-ahead log, or a legacy
+    # .chamber file waiting to be imported.
+    #
+    # inotify, called through ctypes, wakes the watcher as soon as a file
+    # in the directory changes. Where inotify is not available the directory
+    # is scanned every `interval` seconds. Either way a change is only
+    # reported when the size or mtime of a definition file has changed, so
+    # the many other files bots write to the data directory, and SQLite
+    # readers creating and removing an empty WAL, do not count.
+
+    @staticmethod
+    def is_definition_file(name):
+        return name in ("chambers.db", "chambers.db-wal") or name.endswith(".chamber")
+
+    @staticmethod
+    def open_inotify(path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            return fd
+        except (OSError, AttributeError) as e:
+            log.info(f"inotify not available for {path}, scanning instead, {e}")
+            return None
+
+    def __init__(self, path, interval=5.0, debounce=1.0):
+        self.path = path
+        self.interval = interval
+        self.debounce = debounce
+        self.fd = DataDirWatcher.open_inotify(path)
+        self.signature = self.scan()
+
+    def scan(self):
+        signature = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            log.warning(f"Could not scan {self.path}, {e}")
+            return self.signature
+        for name in names:
+            if not DataDirWatcher.is_definition_file(name):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            if name.endswith("-wal") and not stat.st_size:
+                continue
+            signature[name] = (stat.st_mtime_ns, stat.st_size)
+        return signature
+
+    def read_events(self):
+        # True when any event names a definition file
+        relevant = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return relevant
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                relevant |= DataDirWatcher.is_definition_file(os.fsdecode(name))
+                offset += EVENT_HEADER.size + length
+
+    def wait_for_event(self):
+        if self.fd is None:
+            time.sleep(self.interval)
+            return
+        # Still rescan now and then, in case an event was missed
+        deadline = time.monotonic() + self.interval * 12
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return
+            if self.read_events():
+                break
+        # Let a burst of writes settle before looking
+        time.sleep(self.debounce)
+        self.read_events()
+
+    def wait(self):
+        # Blocks until the definition files have changed
+        while True:
+            self.wait_for_event()
+            signature = self.scan()
+            if signature != self.signature:
+                self.signature = signature
+                return